@@ -3,6 +3,11 @@ lengths_dataset_path = 'anticipated_vs_actual/data/batches'
 cramming_threshold_before = 115
 cramming_threshold_after = 235
 
+switch_date = '2017-11-07'
+first_day = '2017-01-01'
+last_day = '2019-12-31'
+max_n_chars = 280
+
 mobile_sources = ['<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
                  '<a href="http://twitter.com/download/android" rel="nofollow">Twitter for Android</a>',
                  '<a href="http://twitter.com/#!/download/ipad" rel="nofollow">Twitter for iPad</a>',
@@ -12,6 +17,8 @@ web_sources = ['<a href="http://twitter.com" rel="nofollow">Twitter Web Client</
 
 allowed_sources = web_sources + mobile_sources
 
+source_types = ['mobile', 'web', 'automated']
+
 allowed_languages = ['ar', 'nl','en', 'et', 'fr',\
                      'de','ht','hi', 'in', 'it', 'fa',\
                      'pl','pt', 'ru', 'es', 'sv', 'tl',\
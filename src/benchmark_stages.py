@@ -0,0 +1,191 @@
+import argparse
+import glob
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+from queue import Empty
+
+import pyarrow.parquet as pq
+
+import executors
+from constants import allowed_languages, allowed_sources, lengths_dataset_path, switch_date
+from histograms import HistogramAccumulator, classify_sources, groupby_histograms
+from measure import fit_methods, measures
+from measurements_io import write_measurements
+from synthetic_dataset import generate_dataset
+from tweets_multiprocessing import read_batch
+
+stages = ['read', 'filter', 'convert_source', 'histograms', 'reduce', 'fit', 'csv']
+columns = ['lang', 'n_chars', 'source', 'created_at']
+
+
+def read_batches(files):
+    return [read_batch(file, columns) for file in files]
+
+
+def batch_histograms(df):
+    df = df.assign(source_type=classify_sources(df.source))
+    return groupby_histograms(df.groupby([df.source_type, df.lang, df.created_at.dt.normalize()], observed=True), df['n_chars'])
+
+
+def merge_histograms(hists):
+    accumulator = HistogramAccumulator()
+    for batch_hists in hists:
+        accumulator.add(batch_hists)
+    return accumulator.to_frame()
+
+
+def run_stage(stage, files, fit_method):
+    # returns how many rows the stage processed and how long it took, everything the stage needs is prepared
+    # before the timer starts
+    if stage == 'read':
+        start = time.perf_counter()
+        rows = sum(len(df) for df in read_batches(files))
+        return rows, time.perf_counter() - start
+    if stage == 'filter':
+        # the filters of the daily scripts after the switch, pushed into the parquet scan as the scripts do,
+        # rows are those of the batches so that the throughput compares to the unfiltered read
+        rows = sum(pq.read_metadata(file).num_rows for file in files)
+        start = time.perf_counter()
+        for file in files:
+            read_batch(file, columns, langs=allowed_languages, sources=allowed_sources, start=switch_date)
+        return rows, time.perf_counter() - start
+    dfs = read_batches(files)
+    rows = sum(len(df) for df in dfs)
+    start = time.perf_counter()
+    if stage == 'convert_source':
+        for df in dfs:
+            classify_sources(df.source)
+        return rows, time.perf_counter() - start
+    if stage == 'histograms':
+        for df in dfs:
+            batch_histograms(df)
+        return rows, time.perf_counter() - start
+    hists = [batch_histograms(df) for df in dfs]
+    start = time.perf_counter()
+    if stage == 'reduce':
+        merge_histograms(hists)
+        return rows, time.perf_counter() - start
+    hists = merge_histograms(hists)
+    start = time.perf_counter()
+    if stage == 'fit':
+        measures(hists, 280, ['runover', 'cramming'], method=fit_method)
+        # histograms rather than tweets for this stage
+        return len(hists), time.perf_counter() - start
+    df = measures(hists, 280, ['runover', 'cramming'], method='fast').melt(var_name='measure',
+                                                                         value_name='measurement', ignore_index=False)
+    with tempfile.TemporaryDirectory() as save_path:
+        start = time.perf_counter()
+        write_measurements(df, save_path, 'benchmark')
+        return len(df), time.perf_counter() - start
+
+
+def stage_process(stage, files, fit_method, queue):
+    rows, seconds = run_stage(stage, files, fit_method)
+    # peak resident memory of the process that ran the stage, in kB on Linux
+    queue.put((rows, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def wait_for_stage(process, queue, poll_seconds=1):
+    # the result of the stage, None when its process died without one (killed for its memory or an exception)
+    while True:
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            if not process.is_alive():
+                # the result can arrive right after the process exited
+                try:
+                    return queue.get(timeout=poll_seconds)
+                except Empty:
+                    return None
+
+
+def benchmark(files, fit_method='batch', selected_stages=stages):
+    # every stage runs in a fresh process so that its peak memory isn't hidden by the previous stages
+    context = get_context('fork')
+    results = {}
+    for stage in selected_stages:
+        queue = context.Queue()
+        process = context.Process(target=stage_process, args=(stage, files, fit_method, queue))
+        process.start()
+        result = wait_for_stage(process, queue)
+        process.join()
+        if result is None or process.exitcode:
+            results[stage] = {'failed': True, 'exitcode': process.exitcode}
+            print(f"{stage:>15}: failed, exit code {process.exitcode}")
+            continue
+        rows, seconds, peak_rss = result
+        results[stage] = {'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / seconds if seconds else None,
+                          'peak_rss_mb': peak_rss}
+        print(f"{stage:>15}: {seconds:8.3f} s, {results[stage]['rows_per_sec'] or 0:14,.0f} rows/s,"
+              f" peak RSS {peak_rss:8.1f} MB")
+    if 'seconds' in results.get('read', {}) and 'seconds' in results.get('filter', {}):
+        print(f"The filtered read takes {results['filter']['seconds'] / results['read']['seconds']:.2f}x the time of"
+              " the unfiltered one")
+    return results
+
+
+def get_failed(results):
+    return [stage for stage, result in results.items() if result.get('failed')]
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    # stages slower than the baseline by more than tolerance are regressions
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline or result.get('failed') or baseline[stage].get('failed'):
+            continue
+        ratio = result['seconds'] / baseline[stage]['seconds']
+        print(f"{stage:>15}: {ratio:6.2f}x the baseline time")
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Time every stage of the pipeline (parquet read, filtered read, convert_source, histograms, reduce,'
+                    ' fitting, csv write) separately and record rows/sec and peak RSS')
+
+    parser.add_argument('--data-path', help=f'Directory of the batches, default: {lengths_dataset_path}',
+                        default=lengths_dataset_path)
+    parser.add_argument('--generate', type=int, default=None,
+                        help='Benchmark on this many synthetic tweets generated in a temporary directory instead')
+    parser.add_argument('--stages', nargs='+', choices=stages, default=stages, help='Which stages to run, default: all')
+    parser.add_argument('--fit-method', choices=fit_methods, default='batch', help='Fit method of the fit stage, default: batch')
+    parser.add_argument('--n-cores', type=int, help='How many cores the fit stage can use, default: 20', default=20)
+    parser.add_argument('--output', default=None, help='Where to save the results as json')
+    parser.add_argument('--baseline', default=None, help='Results saved by an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown of a stage over the baseline reported as a regression, default: 0.2')
+
+    args = parser.parse_args()
+    executors.initialize(args.n_cores)
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        if args.generate is not None:
+            print("Generating batches...")
+            files = generate_dataset(tmp_path, args.generate)
+        else:
+            files = sorted(glob.glob(os.path.join(args.data_path, '*.parquet')))
+        print(f"Benchmarking on {len(files)} batches...")
+        results = benchmark(files, fit_method=args.fit_method, selected_stages=args.stages)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    failed = get_failed(results)
+    if failed:
+        print("Failed stages:", ', '.join(failed))
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:", ', '.join(regressions))
+    if failed or regressions:
+        sys.exit(1)
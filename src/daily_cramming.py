@@ -1,13 +1,15 @@
 import argparse
-import os
-from functools import reduce
 
 import pandas as pd
-from measure import cramming_140_wrapper, cramming_280_wrapper
-from pandarallel import pandarallel
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, measures
+import executors
+import instrumentation
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, scan_batch, set_batch_memory
+from histogram_cube import load_cube
+from histograms import classify_sources, groupby_histograms
 
-from constants import allowed_languages, mobile_sources, web_sources
+from constants import allowed_languages, allowed_sources, switch_date
 
 
 def before_daily_wrapper(x):
@@ -19,35 +21,48 @@ def after_daily_wrapper(x):
 
 
 def process_batch_daily(file, before_switch, langs, sources=None, groupby_cols='date'):
-    df = pd.read_parquet(file, columns=['lang', 'n_chars', "source", "created_at"])
-    df = df.loc[df.lang.isin(langs)]
-    if sources == 'allowed':
-        df['source_type'] = df['source'].apply(convert_source)  
-        df = df.loc[df['source_type'].isin(['web', 'mobile'])]
-    elif sources == 'all':
-        df['source_type'] = df['source'].apply(convert_source)  
-    if before_switch:
-        df = df[df["created_at"] < "2017-11-07"]
+    if not isinstance(file, str):
+        # a HistogramCube already holds the counts of all batches
+        return file.daily_histograms(before_switch, langs, sources=sources, groupby_cols=groupby_cols)
+    hists = scan_batch(file, lambda df: daily_histograms(df, sources, groupby_cols),
+                       columns=['lang', 'n_chars', "source", "created_at"], langs=langs,
+                       sources=allowed_sources if sources == 'allowed' else None,
+                       start=None if before_switch else switch_date, end=switch_date if before_switch else None)
+    # keep days as dates in the index
+    if isinstance(hists.index, pd.MultiIndex):
+        hists.index = hists.index.set_levels(hists.index.levels[-1].date, level=-1)
     else:
-        df = df[df["created_at"] >= "2017-11-07"]
-    groupby_obj = df.groupby(df.created_at.dt.date)
+        hists.index = pd.Index(hists.index.date, name='created_at')
+    return hists
+
+
+def daily_histograms(df, sources=None, groupby_cols='date'):
+    if sources in ['allowed', 'all']:
+        df['source_type'] = classify_sources(df['source'])
+    day = df.created_at.dt.normalize()
+    # lang is categorical, only the languages of the batch get a histogram
+    groupby_obj = df.groupby(day)
     if groupby_cols == "lang":
-        groupby_obj = df.groupby([df.lang, df.created_at.dt.date])
+        groupby_obj = df.groupby([df.lang, day], observed=True)
     elif groupby_cols == "source":
-        groupby_obj = df.groupby([df.source_type, df.created_at.dt.date])
+        groupby_obj = df.groupby([df.source_type, day])
     elif groupby_cols == ["source", "lang"]:
-        groupby_obj = df.groupby([df.source_type, df.lang, df.created_at.dt.date])
-    return groupby_obj.apply(lambda x: pd.Series({
-        'hist_chars': x['n_chars'].value_counts()
-    }))
-
-def convert_source(text):
-    if text in mobile_sources:
-        return 'mobile'
-    elif text in web_sources:
-        return 'web'
-    else:
-        return 'automated'
+        groupby_obj = df.groupby([df.source_type, df.lang, day], observed=True)
+    return groupby_histograms(groupby_obj, df['n_chars'])
+
+
+def daily_measurements(before, after, options):
+    before = measures(before, 140, ['cramming'], **options)
+    after_280 = measures(after, 280, ['cramming'], **options)
+    after_140 = measures(after, 140, ['cramming'], **options)
+
+    after_140['cramming_at'] = 140
+    before['cramming_at'] = 140
+    after_280['cramming_at'] = 280
+
+    df = pd.concat([before, after_140, after_280])
+    df.index = pd.to_datetime(df.index)
+    return df.sort_index()
 
 
 if __name__ == "__main__":
@@ -57,29 +72,32 @@ if __name__ == "__main__":
     parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily cramming at 140 before the switch...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
-    before = before.parallel_apply(cramming_140_wrapper, axis=1).to_frame().rename({0: "cramming"}, axis=1)
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
 
     print("Calculating daily cramming at 140 and 280 after the switch...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
-    after_280 = after.parallel_apply(cramming_280_wrapper, axis=1).to_frame().rename({0: "cramming"}, axis=1)
-    after_140 = after.parallel_apply(cramming_140_wrapper, axis=1).to_frame().rename({0: "cramming"}, axis=1)
-
-    after_140['cramming_at'] = 140
-    before['cramming_at'] = 140
-    after_280['cramming_at'] = 280
-
-    df = pd.concat([before, after_140, after_280])
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
+    df = daily_measurements(before, after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "fig3_fig4_daily_cramming_allowed_langs_all_source.csv.gz"))
+    write_measurements(df, args.save_path, "fig3_fig4_daily_cramming_allowed_langs_all_source", output_format=args.output_format)
@@ -1,13 +1,14 @@
 import argparse
-import os
-from functools import reduce
 import warnings
 import pandas as pd
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
-from measure import cramming_280_wrapper
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, lay_out_bounds, measures_per_group
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 
 from constants import lang_sorted
@@ -19,6 +20,24 @@ def after_daily_wrapper(x):
     return process_batch_daily(x, before_switch=False,  langs=lang_sorted, sources="allowed", groupby_cols='lang')
 
 
+def melt_languages(after):
+    new_index = pd.date_range(pd.Timestamp('2017-01-01 00:00:00'), pd.Timestamp(after.index.max()), freq='D')
+    before_after = after.reindex(new_index).reset_index().rename({"index": "date"}, axis=1).reset_index().set_index("date")
+
+    df = before_after.melt(id_vars=['index'], value_vars=['ar', 'de', 'en', 'es', 'et', 'fa', 'fr', 'hi',\
+                                                          'ht', 'in', 'it', 'ja', 'ko', 'nl', 'pl', 'pt',\
+                                                          'ru', 'sv', 'th', 'tl', 'tr', 'ur', 'zh'],\
+                        ignore_index=False, value_name='cramming280')
+    df.index = pd.to_datetime(df.index)
+    df = df.sort_index()
+    df.loc[df.index < "2017-11-07"] = df.loc[df.index < "2017-11-07"].fillna(0)
+    return df
+
+
+def daily_measurements(after, options):
+    after = measures_per_group(after, "lang", 280, ['cramming'], **options)
+    return lay_out_bounds(lambda suffix: melt_languages(after['cramming' + suffix]), options['n_replicates'])
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Daily cramming for all languages, sources: web and mobile together')
@@ -26,27 +45,29 @@ if __name__ == "__main__":
     parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily cramming at 280 per language...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=20)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
     after = after.reset_index(level=0)
-    after = after.groupby("lang").apply(lambda x: x.parallel_apply(cramming_280_wrapper, axis=1)).T
-
-    new_index = pd.date_range(pd.Timestamp('2017-01-01 00:00:00'), pd.Timestamp(after.index.max()), freq='D')
-    before_after = after.reindex(new_index).reset_index().rename({"index": "date"}, axis=1).reset_index().set_index("date")
-
-    df = before_after.melt(id_vars=['index'], value_vars=['ar', 'de', 'en', 'es', 'et', 'fa', 'fr', 'hi',\
-                                                          'ht', 'in', 'it', 'ja', 'ko', 'nl', 'pl', 'pt',\
-                                                          'ru', 'sv', 'th', 'tl', 'tr', 'ur', 'zh'],\
-                        ignore_index=False, value_name='cramming280')
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
-    df.loc[df.index < "2017-11-07"] = df.loc[df.index < "2017-11-07"].fillna(0)
+    df = daily_measurements(after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "fig7_daily_cramming_all_langs.csv.gz"))
+    write_measurements(df, args.save_path, "fig7_daily_cramming_all_langs", output_format=args.output_format)
@@ -1,13 +1,14 @@
 import argparse
-import os
-from functools import reduce
 import warnings
 import pandas as pd
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
-from measure import cramming_140_wrapper, cramming_280_wrapper
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, measures
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 
 from constants import lang_sorted
@@ -25,6 +26,17 @@ def after_daily_wrapper(x):
                                langs=lang_sorted, sources="all",
                                groupby_cols=["source", "lang"])
 
+
+def daily_measurements(before, after, options):
+    before = measures(before, 140, ['cramming'], **options)
+    after280 = measures(after, 280, ['cramming'], **options)
+    after140 = measures(after, 140, ['cramming'], **options)
+
+    before['cramming_at'] = 140
+    after140['cramming_at'] = 140
+    after280['cramming_at'] = 280
+    return pd.concat([before, after140, after280])
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Daily cramming at 140 and 280 per source: web, mobile and automated for all languages')
@@ -32,29 +44,32 @@ if __name__ == "__main__":
     parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily cramming at 140 before the switch per source...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
-    before = before.parallel_apply(cramming_140_wrapper, axis=1)
-    before = before.to_frame().rename({0: "cramming"}, axis=1)
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
 
     print("Calculating daily cramming at 140 and 280 after the switch per source...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
-    after280 = after.parallel_apply(cramming_280_wrapper, axis=1)
-    after140 = after.parallel_apply(cramming_140_wrapper, axis=1)
-    after140 = after140.to_frame().rename({0: "cramming"}, axis=1)
-    after280 = after280.to_frame().rename({0: "cramming"}, axis=1)
-
-    before['cramming_at'] = 140
-    after140['cramming_at'] = 140
-    after280['cramming_at'] = 280
-    df = pd.concat([before, after140, after280])
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
+    df = daily_measurements(before, after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "daily_cramming_per_lang_per_source.csv.gz"))
+    write_measurements(df, args.save_path, "daily_cramming_per_lang_per_source", output_format=args.output_format)
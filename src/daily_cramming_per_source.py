@@ -1,13 +1,14 @@
 import argparse
-import os
-from functools import reduce
 import warnings
 import pandas as pd
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
-from measure import cramming_140_wrapper, cramming_280_wrapper
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, lay_out_bounds, measures_per_group
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 
 from constants import allowed_languages
@@ -21,6 +22,23 @@ def before_daily_wrapper(x):
 def after_daily_wrapper(x):
     return process_batch_daily(x, before_switch=False, langs=allowed_languages, sources="all", groupby_cols='source')
 
+
+def melt_sources(before, after_140, after_280):
+    df = pd.concat([before.assign(cramming_at=140), after_140.assign(cramming_at=140),
+                    after_280.assign(cramming_at=280)])
+    df = df.melt(id_vars=['cramming_at'],\
+                ignore_index=False, value_name='cramming')
+    df.index = pd.to_datetime(df.index)
+    return df.sort_index()
+
+
+def daily_measurements(before, after, options):
+    before = measures_per_group(before, "source_type", 140, ['cramming'], **options)
+    after_280 = measures_per_group(after, "source_type", 280, ['cramming'], **options)
+    after_140 = measures_per_group(after, "source_type", 140, ['cramming'], **options)
+    return lay_out_bounds(lambda suffix: melt_sources(before['cramming' + suffix], after_140['cramming' + suffix],
+                                                      after_280['cramming' + suffix]), options['n_replicates'])
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Daily cramming per source: web, mobile and automated for languages that experienced the switch')
@@ -28,36 +46,34 @@ if __name__ == "__main__":
     parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily cramming at 140 before the switch per source...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
     before = before.reset_index(level=0)
-    before = before.groupby("source_type")\
-            .apply(lambda x: x.parallel_apply(cramming_140_wrapper, axis=1)).T
 
     print("Calculating daily cramming at 140 and 280 after the switch per source...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
     after = after.reset_index(level=0)
-    after_280 = after.groupby("source_type")\
-            .apply(lambda x: x.parallel_apply(cramming_280_wrapper, axis=1)).T
-    after_140 = after.groupby("source_type")\
-            .apply(lambda x: x.parallel_apply(cramming_140_wrapper, axis=1)).T
-
-    before['cramming_at'] = 140
-    after_140['cramming_at'] = 140
-    after_280['cramming_at'] = 280
-
-    df = pd.concat([before, after_140, after_280])
-    df = df.melt(id_vars=['cramming_at'],\
-                ignore_index=False, value_name='cramming')
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
+    df = daily_measurements(before, after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "fig9_daily_cramming_per_source.csv.gz"))
+    write_measurements(df, args.save_path, "fig9_daily_cramming_per_source", output_format=args.output_format)
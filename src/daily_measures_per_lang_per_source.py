@@ -1,15 +1,14 @@
 import argparse
-import os
-from functools import reduce
 import warnings
 import pandas as pd
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
-from measure import cramming_140_wrapper, cramming_280_wrapper
-from daily_runover_vs_cramming_280_per_source import runover_280_wrapper
-from daily_runover_vs_fraction_140 import get_empirical_density
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, measure_columns, measures
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 
 from constants import lang_sorted
@@ -27,41 +26,18 @@ def after_daily_wrapper(x):
                                langs=lang_sorted, sources="all",
                                groupby_cols=["source", "lang"])
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='Daily measures per source: web, mobile and automated and per language for all 23 languages')
-
-    parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
-    parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
-                        default='../data/measurements')
 
-    args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
-    files = get_files()
-
-    print("Calculating daily cramming at 140 and runonver at 280 before the switch per source, per language...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
-    before_cramming_140 = before.parallel_apply(cramming_140_wrapper, axis=1)
-    before_runover_280 = before.parallel_apply(runover_280_wrapper, axis=1)
-    before_cramming_140 = before_cramming_140.to_frame().rename({0: "measurement"}, axis=1)
+def daily_measurements(before, after, options):
+    before_cramming_140 = measure_columns(measures(before, 140, ['cramming'], **options), 'cramming', "measurement")
+    before_runover_280 = measure_columns(measures(before, 280, ['runover'], **options), 'runover', "measurement")
     before_cramming_140['measure'] = 'cramming'
-    before_runover_280 = before_runover_280.to_frame().rename({0: "measurement"}, axis=1)
     before_runover_280['measure'] = 'cramming'
 
-    print("Calculating daily cramming at 140 and 280 and runover at 280 after the switch per source, per language...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
-    after_cramming_280 = after.parallel_apply(cramming_280_wrapper, axis=1)
-    after_cramming_140 = after.parallel_apply(cramming_140_wrapper, axis=1)
-    after_runover_280 = after.parallel_apply(runover_280_wrapper, axis=1)
-    after_cramming_140 = after_cramming_140.to_frame().rename({0: "measurement"}, axis=1)
-    after_cramming_280 = after_cramming_280.to_frame().rename({0: "measurement"}, axis=1)
-    after_runover_280 = after_runover_280.to_frame().rename({0: "measurement"}, axis=1)
-
-    print("Calculating daily fraction of tweets longer than 140 after the switch...")
-    after_empirical_140 = after.parallel_apply(get_empirical_density, axis=1)
-    after_empirical_140 = after_empirical_140.to_frame().rename({0: "measurement"}, axis=1)
+    after_280 = measures(after, 280, ['cramming', 'runover', 'empirical fraction'], **options)
+    after_cramming_140 = measure_columns(measures(after, 140, ['cramming'], **options), 'cramming', "measurement")
+    after_cramming_280 = measure_columns(after_280, 'cramming', "measurement")
+    after_runover_280 = measure_columns(after_280, 'runover', "measurement")
+    after_empirical_140 = measure_columns(after_280, 'empirical fraction', "measurement")
     
     after_empirical_140['measure'] = 'empirical fraction'
     after_cramming_140['measure'] = 'cramming'
@@ -78,7 +54,41 @@ if __name__ == "__main__":
                     after_cramming_140, after_cramming_280,
                      after_runover_280, after_empirical_140])
 
-    df = df.reset_index().set_index('created_at')
+    return df.reset_index().set_index('created_at')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Daily measures per source: web, mobile and automated and per language for all 23 languages')
+
+    parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
+    parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
+                        default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
+
+    args = parser.parse_args()
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
+    files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
+
+    print("Calculating daily cramming at 140 and runonver at 280 before the switch per source, per language...")
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
+
+    print("Calculating daily cramming at 140 and 280 and runover at 280 after the switch per source, per language...")
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
+    df = daily_measurements(before, after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "daily_measures_per_lang_per_source.csv.gz"))
+    write_measurements(df, args.save_path, "daily_measures_per_lang_per_source", output_format=args.output_format)
@@ -1,36 +1,38 @@
 import argparse
-import os
 import warnings
-from functools import reduce
 import pandas as pd
 import numpy as np
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
+from daily_num_chars import get_probabilities
 from daily_runover_vs_cramming_280_per_source import before_daily_wrapper, after_daily_wrapper
-from measure import measure
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, num_chars_frame
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 
 warnings.filterwarnings('ignore', category=OptimizeWarning)
 
 
-def before_num_chars_wrapper(day_hist, probabilities=[0.95]):
-    return measure(day_hist=day_hist, measure='num_chars', measurement_at=140, probabilities=probabilities)
-
-
-def after_num_chars_wrapper(day_hist, probabilities=[0.95]):
-    return measure(day_hist=day_hist, measure='num_chars', measurement_at=280, probabilities=probabilities)
-
-def postprocess(df, probs, sources=['web', 'mobile']):
+def source_num_chars(hists, measurement_at, probabilities, options, sources=['web', 'mobile']):
+    # long format num_chars of every source, one vectorized call per source
     outputs = []
     for source in sources:
-        source_df = pd.DataFrame(df[source].tolist(), index=df.index, columns=probs)
-        source_df = source_df.melt(var_name='probability', value_name='num_chars', ignore_index=False)
+        source_hists = hists[hists.source_type == source].drop('source_type', axis=1)
+        source_df = num_chars_frame(source_hists, measurement_at, probabilities=probabilities, **options)
         source_df['source_type'] = source
         outputs.append(source_df)
     return outputs
 
 
+def daily_measurements(before, after, probabilities, options):
+    before_outputs = source_num_chars(before, 140, probabilities, options)
+    after_outputs = source_num_chars(after, 280, probabilities, options)
+    return pd.concat(before_outputs + after_outputs)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Daily number of characters for which a fraction of tweets would be below or equal to it,'
@@ -40,39 +42,43 @@ if __name__ == "__main__":
                         default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
     parser.add_argument('--probabilities', nargs="+", help='List of probabilities at which to evaluate quantile function '
                                               'to obtain number of characters, default: [95%%, 96%%, 97%%, 98%%, 99%%]',
                         default=np.arange(0.95, 0.99, 0.01))
+    parser.add_argument('--probability-grid', nargs=3, type=float, default=None, metavar=('START', 'STOP', 'STEP'),
+                        help='Evaluate the quantile function at every probability from START to STOP included in steps'
+                             ' of STEP instead, e.g. 0.9 0.999 0.001')
 
     args = parser.parse_args()
-    args.probabilities = list(map(lambda x: float(x), args.probabilities))
-    pandarallel.initialize(nb_workers=args.n_cores)
+    args.probabilities = get_probabilities(args)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print(f"Calculating daily hypothetical number of characters for which {[int(prob*100) for prob in args.probabilities]}% of "
           f"tweets are shorter or equal before the switch...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
     before = before.reset_index(level=0)
 
-    before_num_chars = before.groupby("source_type").apply(lambda x: x.parallel_apply(before_num_chars_wrapper,
-                                                                                      probabilities=args.probabilities,
-                                                                                      axis=1)).T
-
-    before_outputs = postprocess(before_num_chars, probs=args.probabilities)                                      
-
     print(f"Calculating daily hypothetical number of characters for which {[int(prob*100) for prob in args.probabilities]}% of "
           f"tweets are shorter or equal after the switch...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
     after = after.reset_index(level=0)
-    after_num_chars = after.groupby("source_type").apply(lambda x: x.parallel_apply(after_num_chars_wrapper,
-                                                                                    probabilities=args.probabilities,
-                                                                                    axis=1)).T
-    
-    after_outputs = postprocess(after_num_chars, probs=args.probabilities)                                      
-
-    df = pd.concat(before_outputs + after_outputs)
+    df = daily_measurements(before, after, args.probabilities, fit_options(args))
 
     print("Saving file...")
-    df.to_csv(os.path.join(args.save_path, "daily_num_chars_per_source.csv.gz"))
+    write_measurements(df, args.save_path, "daily_num_chars_per_source", output_format=args.output_format)
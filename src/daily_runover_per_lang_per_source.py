@@ -1,13 +1,14 @@
 import argparse
-import os
-from functools import reduce
 import warnings
 import pandas as pd
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
-from daily_runover_vs_cramming_280 import runover_280_wrapper
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, lay_out_bounds, measures_per_group
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 
 from constants import lang_sorted
@@ -20,13 +21,9 @@ def after_daily_wrapper(x):
                                sources="allowed", groupby_cols=["source", "lang"])
 
 
-def postprocess(df, after, source):
+def postprocess(df, after):
     new_index = pd.date_range(pd.Timestamp('2017-01-01 00:00:00'), pd.Timestamp(after.index.max()), freq='D')
     df = df.reindex(new_index).reset_index().rename({"index": "date"}, axis=1).reset_index().set_index("date")
-    if source == 'web':
-        df.columns = df.columns.droplevel(0)
-        df = df.rename_axis(None, axis=1)
-        df = df.rename({'': "index"}, axis=1)
     df = df.melt(id_vars=['index'], value_vars=['ar', 'de', 'en', 'es', 'et', 'fa', 'fr', 'hi',\
                                                 'ht', 'in', 'it', 'ja', 'ko', 'nl', 'pl', 'pt',\
                                                 'ru', 'sv', 'th', 'tl', 'tr', 'ur', 'zh'],\
@@ -36,6 +33,17 @@ def postprocess(df, after, source):
     df.loc[df.index < "2017-11-07"] = df.loc[df.index < "2017-11-07"].fillna(0)
     return df
 
+
+def daily_measurements(after, options):
+    outputs = []
+    for source in ['web', 'mobile']:
+        runovers = measures_per_group(after[after.source_type == source].drop("source_type", axis=1), "lang", 280,
+                                      ['runover'], **options)
+        df = lay_out_bounds(lambda suffix: postprocess(runovers['runover' + suffix], after), options['n_replicates'])
+        df['source'] = source
+        outputs.append(df)
+    return pd.concat(outputs)
+
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -44,27 +52,29 @@ if __name__ == "__main__":
     parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily runover at 280 per language...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
     after = after.reset_index(level=[0, 1])
-
-    web = after[after.source_type == 'web'].drop("source_type", axis=1)
-    mobile = after[after.source_type == 'mobile'].drop("source_type", axis=1)
-    web = web.groupby("lang").apply(lambda x: x.parallel_apply(runover_280_wrapper, axis=1))
-    mobile = mobile.groupby("lang").apply(lambda x: x.parallel_apply(runover_280_wrapper, axis=1)).T
-    web = web.reset_index(level=0).pivot(columns='lang')
-
-    df_web = postprocess(web, after, source='web')
-    df_mobile = postprocess(mobile, after, source='mobile')
-    df_web['source'] = 'web'
-    df_mobile['source'] = 'mobile'
-    df = pd.concat([df_web, df_mobile])
+    df = daily_measurements(after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "daily_runover_per_lang_per_source.csv.gz"))
+    write_measurements(df, args.save_path, "daily_runover_per_lang_per_source", output_format=args.output_format)
@@ -1,13 +1,14 @@
 import argparse
-import os
-from functools import reduce
 import warnings
 import pandas as pd
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
-from measure import measure
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, measure_columns, measures
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 
 from constants import allowed_languages
@@ -22,12 +23,21 @@ def after_daily_wrapper(x):
     return process_batch_daily(x, before_switch=False, langs=allowed_languages, sources="allowed")
 
 
-def runover_280_wrapper(day_hist):
-    return measure(day_hist=day_hist, measurement_at=280, measure='runover')
+def daily_measurements(before, after, options):
+    before280_runover = measure_columns(measures(before, 280, ['runover'], **options), 'runover', "measurement")
+    before280_runover['measure'] = 'runover'
 
+    after280_both = measures(after, 280, ['runover', 'cramming'], **options)
 
-def both_280_wrapper(day_hist):
-    return measure(day_hist=day_hist, measurement_at=280, measure='both')
+    df1 = measure_columns(after280_both, 'runover', 'measurement')
+    df2 = measure_columns(after280_both, 'cramming', 'measurement')
+
+    df1['measure'] = 'runover'
+    df2['measure'] = 'cramming'
+
+    df = pd.concat([before280_runover, df1, df2])
+    df.index = pd.to_datetime(df.index)
+    return df
 
 
 if __name__ == "__main__":
@@ -37,33 +47,30 @@ if __name__ == "__main__":
     parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily runover at 280 before the switch...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
-    before280_runover = before.parallel_apply(runover_280_wrapper, axis=1)
-
-    before280_runover = before280_runover.to_frame().rename({0: "measurement"}, axis=1)
-    before280_runover['measure'] = 'runover'
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
 
     print("Calculating daily runover and cramming at 280 after the switch...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
-    after280_both = after.parallel_apply(both_280_wrapper, axis=1)
-
-    after280_both = pd.DataFrame(after280_both.tolist(),\
-                             index=after280_both.index).rename({0: "runover", 1:"cramming"}, axis=1)
-
-    df1 = after280_both.runover.to_frame().rename({'runover': 'measurement'}, axis=1)
-    df2 = after280_both.cramming.to_frame().rename({'cramming': 'measurement'}, axis=1)
-
-    df1['measure'] = 'runover'
-    df2['measure'] = 'cramming'
-
-    df = pd.concat([before280_runover, df1, df2])
-    df.index = pd.to_datetime(df.index)
-    df.to_csv(os.path.join(args.save_path, "daily_runover_vs_cramming.csv.gz"))
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
+    df = daily_measurements(before, after, fit_options(args))
+    write_measurements(df, args.save_path, "daily_runover_vs_cramming", output_format=args.output_format)
@@ -1,13 +1,14 @@
 import argparse
-import os
-from functools import reduce
 import warnings
 import pandas as pd
-from pandarallel import pandarallel
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
 
-from measure import measure
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, lay_out_bounds, measures_per_group
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 
 from constants import allowed_languages
@@ -22,12 +23,23 @@ def after_daily_wrapper(x):
     return process_batch_daily(x, before_switch=False, langs=allowed_languages, sources="allowed", groupby_cols='source')
 
 
-def runover_280_wrapper(day_hist):
-    return measure(day_hist=day_hist, measurement_at=280, measure='runover')
+def melt_sources(before280_runover, after280_runover, after280_cramming):
+    runover_by_source = pd.concat((before280_runover, after280_runover)).assign(measure='runover')
+    cramming_by_source = after280_cramming.assign(measure='cramming')
 
+    df = pd.concat([runover_by_source, cramming_by_source])
+
+    df = df.melt(id_vars=['measure'],\
+                ignore_index=False, value_name='measurement', var_name='source_type')
+    df.index = pd.to_datetime(df.index)
+    return df.sort_index()
 
-def both_280_wrapper(day_hist):
-    return measure(day_hist=day_hist, measurement_at=280, measure='both')
+
+def daily_measurements(before, after, options):
+    before280 = measures_per_group(before, "source_type", 280, ['runover'], **options)
+    after280 = measures_per_group(after, "source_type", 280, ['runover', 'cramming'], **options)
+    return lay_out_bounds(lambda suffix: melt_sources(before280['runover' + suffix], after280['runover' + suffix],
+                                                      after280['cramming' + suffix]), options['n_replicates'])
 
 
 if __name__ == "__main__":
@@ -37,53 +49,34 @@ if __name__ == "__main__":
     parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily runover at 280 before the switch...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
     before = before.reset_index(level=0)
-    before280_runover = before.groupby("source_type")\
-            .apply(lambda x: x.parallel_apply(runover_280_wrapper, axis=1)).T
-   
+
     print("Calculating daily runover and cramming at 280 after the switch...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
     after = after.reset_index(level=0)
-    after280_both = after.groupby("source_type")\
-            .apply(lambda x: x.parallel_apply(both_280_wrapper, axis=1)).T
-
-    web_after = pd.DataFrame(after280_both.web.tolist(), index=after280_both.index).rename({0: "runover", 1:"cramming"}, axis=1)
-    mobile_after = pd.DataFrame(after280_both.mobile.tolist(), index=after280_both.index).rename({0: "runover", 1:"cramming"}, axis=1)
-
-    df1 = web_after.runover
-    df1.name = 'web'
-    df2 = mobile_after.runover
-    df2.name = 'mobile'
-
-    df3 = pd.concat((df2, df1), axis=1)
-    runover_by_source = pd.concat((before280_runover, df3))
-    runover_by_source['measure'] = 'runover'
-
-    df1 = web_after.cramming
-    df1.name = 'web'
-    df2 = mobile_after.cramming
-    df2.name = 'mobile'
-
-    cramming_by_source = pd.concat((df2, df1), axis=1)
-    cramming_by_source['measure'] = 'cramming'
-
-    df = pd.concat([runover_by_source, cramming_by_source])
-    df.head()
-
-    df = df.melt(id_vars=['measure'],\
-                ignore_index=False, value_name='measurement', var_name='source_type')
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
-    df.head()
+    df = daily_measurements(before, after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "daily_runover_vs_cramming_per_source.csv.gz"))
+    write_measurements(df, args.save_path, "daily_runover_vs_cramming_per_source", output_format=args.output_format)
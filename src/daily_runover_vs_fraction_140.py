@@ -1,14 +1,14 @@
 import argparse
-import os
 import warnings
-from functools import reduce
 
-import numpy as np
 import pandas as pd
-from measure import measure
-from pandarallel import pandarallel
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, measure_columns, measures
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
-from tweets_multiprocessing import get_files, multiprocess_batches
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 from daily_cramming import process_batch_daily
 from constants import allowed_languages
 
@@ -16,14 +16,6 @@ from constants import allowed_languages
 warnings.filterwarnings('ignore', category=OptimizeWarning)
 
 
-def get_empirical_density(day_hist, x=140, limit=280):
-    # fill missing values
-    day_hist = day_hist.hist_chars.sort_index()[:limit] \
-        .reindex(index=range(1, limit + 1), fill_value=0).fillna(0)
-    density = (day_hist / np.sum(day_hist))
-    return density[x:].sum()
-
-
 def before_daily_wrapper(x):
     return process_batch_daily(x, before_switch=True, langs=allowed_languages, sources="allowed")
 
@@ -32,16 +24,20 @@ def after_daily_wrapper(x):
     return process_batch_daily(x, before_switch=False, langs=allowed_languages, sources="allowed")
 
 
-def runover_280_wrapper(day_hist):
-    return measure(day_hist=day_hist, measurement_at=280, measure='runover')
-
-
-def both_280_wrapper(day_hist):
-    return measure(day_hist=day_hist, measurement_at=280, measure='both')
+def daily_measurements(before, after, options):
+    before140_both = measures(before, 140, ['runover', 'cramming'], **options)
+    df1 = measure_columns(before140_both, 'runover', 'measurement')
+    df2 = measure_columns(before140_both, 'cramming', 'measurement')
+    df1['measure'] = 'runover'
+    df2['measure'] = 'cramming'
 
+    after140_empirical = measure_columns(measures(after, 280, ['empirical fraction'], **options), 'empirical fraction',
+                                         "measurement")
+    after140_empirical['measure'] = 'empirical fraction'
 
-def before140_both_wrapper(day_hist):
-    return measure(day_hist=day_hist, measure='both', measurement_at=140)
+    df = pd.concat([df1, df2, after140_empirical])
+    df.index = pd.to_datetime(df.index)
+    return df.sort_index()
 
 
 if __name__ == "__main__":
@@ -53,33 +49,33 @@ if __name__ == "__main__":
                         default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily runover and cramming at 140 before the switch...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
-    before140_both = before.parallel_apply(before140_both_wrapper, axis=1)
-    before140_both = pd.DataFrame(before140_both.tolist(),\
-                                index=before140_both.index).rename({0: "runover", 1:"cramming"}, axis=1)
-    df1 = before140_both.runover.to_frame().rename({'runover': 'measurement'}, axis=1)
-    df2 = before140_both.cramming.to_frame().rename({'cramming': 'measurement'}, axis=1)
-    df1['measure'] = 'runover'
-    df2['measure'] = 'cramming'
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
 
     print("Calculating daily fraction of tweets longer than 140 after the switch...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
-    after140_empirical = after.parallel_apply(get_empirical_density, axis=1)
-    after140_empirical = after140_empirical.to_frame().rename({0: "measurement"}, axis=1)
-    after140_empirical['measure'] = 'empirical fraction'
-
-    df = pd.concat([df1, df2, after140_empirical])
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
+    df = daily_measurements(before, after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "daily_runover_vs_fraction.csv.gz"))
+    write_measurements(df, args.save_path, "daily_runover_vs_fraction", output_format=args.output_format)
@@ -1,29 +1,37 @@
 import argparse
-import os
 import warnings
-from functools import reduce
 
-import numpy as np
 import pandas as pd
 from daily_runover_vs_cramming_280_per_source import before_daily_wrapper, after_daily_wrapper
-from measure import measure
-from pandarallel import pandarallel
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, lay_out_bounds, measures_per_group
+import executors
+import instrumentation
 from scipy.optimize import OptimizeWarning
-from tweets_multiprocessing import get_files, multiprocess_batches
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, set_batch_memory
+from histogram_cube import load_cube
 
 warnings.filterwarnings('ignore', category=OptimizeWarning)
 
 
-def get_empirical_density(day_hist, x=140, limit=280):
-    # fill missing values
-    day_hist = day_hist.hist_chars.sort_index()[:limit] \
-        .reindex(index=range(1, limit + 1), fill_value=0).fillna(0)
-    density = (day_hist / np.sum(day_hist))
-    return density[x:].sum()
+def melt_sources(before140_runover, before140_cramming, after140_empirical):
+    runover_by_source = before140_runover.assign(measure='runover')
+    cramming_by_source = before140_cramming.assign(measure='cramming')
+    after140_empirical = after140_empirical.assign(measure='empirical fraction')
 
+    df = pd.concat([runover_by_source, cramming_by_source, after140_empirical])
+
+    df = df.melt(id_vars=['measure'], \
+                 ignore_index=False, value_name='measurement', var_name='source_type')
+    df.index = pd.to_datetime(df.index)
+    return df.sort_index()
 
-def before140_both_wrapper(day_hist):
-    return measure(day_hist=day_hist, measure='both', measurement_at=140)
+
+def daily_measurements(before, after, options):
+    before140 = measures_per_group(before, "source_type", 140, ['runover', 'cramming'], **options)
+    after140 = measures_per_group(after, "source_type", 280, ['empirical fraction'], **options)
+    return lay_out_bounds(lambda suffix: melt_sources(before140['runover' + suffix], before140['cramming' + suffix],
+                                                      after140['empirical fraction' + suffix]), options['n_replicates'])
 
 
 if __name__ == "__main__":
@@ -35,52 +43,34 @@ if __name__ == "__main__":
                         default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
                         default='../data/measurements')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
     files = get_files()
+    cube = load_cube(args.cube) if args.cube else None
 
     print("Calculating daily runover and cramming at 140 before the switch...")
-    output_before = multiprocess_batches(before_daily_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_before))
+    before = get_histograms(before_daily_wrapper, files, cube=cube,
+                            partials=args.partials)
     before = before.reset_index(level=0)
-    before140_both = before.groupby("source_type").apply(lambda x: x.parallel_apply(before140_both_wrapper, axis=1)).T
 
     print("Calculating daily fraction of tweets longer than 140 after the switch...")
-    output_after = multiprocess_batches(after_daily_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: a.add(b, fill_value=0), filter(lambda x: not x.empty, output_after))
+    after = get_histograms(after_daily_wrapper, files, cube=cube,
+                           partials=args.partials)
     after = after.reset_index(level=0)
-    after140_empirical = after.groupby("source_type").apply(lambda x: x.parallel_apply(get_empirical_density, axis=1)).T
-    after140_empirical['measure'] = 'empirical fraction'
-
-    web_before = pd.DataFrame(before140_both.web.tolist(), index=before140_both.index).rename(
-        {0: "runover", 1: "cramming"}, axis=1)
-    mobile_before = pd.DataFrame(before140_both.mobile.tolist(), index=before140_both.index).rename(
-        {0: "runover", 1: "cramming"}, axis=1)
-
-    df1 = web_before.runover
-    df1.name = 'web'
-    df2 = mobile_before.runover
-    df2.name = 'mobile'
-
-    runover_by_source = pd.concat((df2, df1), axis=1)
-    runover_by_source['measure'] = 'runover'
-
-    df1 = web_before.cramming
-    df1.name = 'web'
-    df2 = mobile_before.cramming
-    df2.name = 'mobile'
-
-    cramming_by_source = pd.concat((df2, df1), axis=1)
-    cramming_by_source['measure'] = 'cramming'
-
-    df = pd.concat([runover_by_source, cramming_by_source, after140_empirical])
-    df.head()
-
-    df = df.melt(id_vars=['measure'], \
-                 ignore_index=False, value_name='measurement', var_name='source_type')
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
+    df = daily_measurements(before, after, fit_options(args))
 
     print("Saving to file...")
-    df.to_csv(os.path.join(args.save_path, "daily_runover_vs_fraction_per_source.csv.gz"))
+    write_measurements(df, args.save_path, "daily_runover_vs_fraction_per_source", output_format=args.output_format)
@@ -0,0 +1,103 @@
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Pool, get_context
+from multiprocessing.pool import ThreadPool
+
+backends = ['serial', 'thread', 'process', 'cluster']
+n_workers = os.cpu_count()
+backend = 'process'
+executor = None
+# functions and arguments that set the module state of the workers, applied when they start so that workers
+# which aren't forked from the main process get the same settings
+worker_settings = []
+
+
+def add_executor_arguments(parser):
+    parser.add_argument('--executor', choices=backends, default='process',
+                        help='Where batches and fits run: in the main process (serial), in threads, in a pool of forked'
+                             ' processes or in a local cluster of fresh worker processes, default: process')
+
+
+def initialize(nb_workers, executor_backend='process'):
+    global n_workers, backend
+    n_workers = nb_workers
+    backend = executor_backend
+
+
+def add_worker_setting(func, *args):
+    # must be called before the executor is created
+    worker_settings.append((func, args))
+
+
+def apply_worker_settings(settings):
+    for func, args in settings:
+        func(*args)
+
+
+class SerialExecutor:
+    def __init__(self, n_workers):
+        self.n_workers = 1
+
+    def map(self, func, tasks):
+        return [func(task) for task in tasks]
+
+    def imap_unordered(self, func, tasks):
+        return (func(task) for task in tasks)
+
+    def close(self):
+        pass
+
+
+class PoolExecutor:
+    # tasks are sent one at a time so that they run in the order they are given
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.pool = self.create_pool(n_workers)
+
+    def create_pool(self, n_workers):
+        return Pool(n_workers, initializer=apply_worker_settings, initargs=(worker_settings,))
+
+    def map(self, func, tasks):
+        return self.pool.map(func, tasks, chunksize=1)
+
+    def imap_unordered(self, func, tasks):
+        return self.pool.imap_unordered(func, tasks)
+
+    def close(self):
+        self.pool.terminate()
+
+
+class ThreadExecutor(PoolExecutor):
+    def create_pool(self, n_workers):
+        return ThreadPool(n_workers)
+
+
+class ClusterExecutor:
+    # workers are spawned and only get the state of the worker settings, as on the nodes of a cluster
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.pool = ProcessPoolExecutor(n_workers, mp_context=get_context('spawn'), initializer=apply_worker_settings,
+                                        initargs=(worker_settings,))
+
+    def map(self, func, tasks):
+        return list(self.pool.map(func, tasks))
+
+    def imap_unordered(self, func, tasks):
+        return (future.result() for future in as_completed([self.pool.submit(func, task) for task in tasks]))
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+executor_classes = {'serial': SerialExecutor, 'thread': ThreadExecutor, 'process': PoolExecutor,
+                    'cluster': ClusterExecutor}
+
+
+def get_executor():
+    # one executor for the whole run, created when it is first needed
+    global executor
+    if executor is None:
+        executor = executor_classes[backend](n_workers)
+        atexit.register(executor.close)
+    return executor
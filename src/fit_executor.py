@@ -0,0 +1,63 @@
+import os
+import tempfile
+
+import numpy as np
+
+import executors
+
+# the matrices shared with the workers are memory mapped files, kept in memory when /dev/shm exists
+shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def create_shared(shape):
+    handle, path = tempfile.mkstemp(suffix='.dat', dir=shared_dir)
+    os.close(handle)
+    return path, np.memmap(path, dtype=float, mode='w+', shape=shape)
+
+
+def get_chunk_size(n_rows):
+    # a few chunks per worker so that slow chunks can be balanced
+    return max(1, -(-n_rows // (4 * executors.get_executor().n_workers)))
+
+
+def get_ranges(n_rows, chunk_size=None):
+    chunk_size = get_chunk_size(n_rows) if chunk_size is None else chunk_size
+    return [(start, min(start + chunk_size, n_rows)) for start in range(0, n_rows, chunk_size)]
+
+
+def map_task(task):
+    func, input_path, output_path, shape, n_outputs, ranges = task
+    density = np.memmap(input_path, dtype=float, mode='r', shape=shape)
+    output = np.memmap(output_path, dtype=float, mode='r+', shape=(shape[0], n_outputs))
+    for start, stop in ranges:
+        output[start:stop] = func(np.array(density[start:stop]))
+    output.flush()
+
+
+def map_ranges(func, density, ranges, n_outputs, chunk_size=None):
+    # output[start:stop] = func(density[start:stop]) for every range, evaluated by the pool with density and output
+    # in shared memory so that only the ranges are sent to the workers, ranges are grouped in tasks of chunk_size rows
+    n_rows = len(density)
+    chunk_size = get_chunk_size(n_rows) if chunk_size is None else chunk_size
+    tasks, task, task_size = [], [], 0
+    for start, stop in ranges:
+        task.append((start, stop))
+        task_size += stop - start
+        if task_size >= chunk_size:
+            tasks.append(task)
+            task, task_size = [], 0
+    if task:
+        tasks.append(task)
+
+    input_path, shared_density = create_shared(density.shape)
+    output_path, output = create_shared((n_rows, n_outputs))
+    try:
+        shared_density[:] = density
+        shared_density.flush()
+        executors.get_executor().map(map_task, [(func, input_path, output_path, density.shape, n_outputs, task)
+                                                for task in tasks])
+        return np.array(output)
+    finally:
+        del shared_density, output
+        os.remove(input_path)
+        os.remove(output_path)
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+# sqlite limits the number of parameters of a query
+max_query_digests = 500
+# file systems on which the locks of sqlite, and the shared memory of its WAL mode, don't work across nodes
+network_filesystems = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph', 'glusterfs', 'lustre', 'gpfs', 'beegfs', '9p',
+                       'afs', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.cephfs'}
+
+
+def histogram_digests(counts):
+    return [hashlib.sha1(np.ascontiguousarray(row, dtype=np.int64).tobytes()).hexdigest() for row in counts]
+
+
+def get_filesystem(path, mounts_path='/proc/mounts'):
+    # type of the file system holding path, from the longest mount point containing it, None without /proc/mounts
+    try:
+        with open(mounts_path) as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    filesystem, longest = None, -1
+    for mount_point, filesystem_type in mounts:
+        mount_point = mount_point.replace('\\040', ' ')
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > longest:
+            filesystem, longest = filesystem_type, len(mount_point)
+    return filesystem
+
+
+def is_node_local(path):
+    return get_filesystem(os.path.dirname(os.path.abspath(path))) not in network_filesystems
+
+
+class FitStore:
+    # lognormal parameters fitted by any script, keyed by a digest of the histogram counts, the limit and the
+    # fit method, in a sqlite database so that concurrent processes of one node can read and write it,
+    # the store must be on a local disk: sqlite in WAL mode isn't safe on network file systems
+    def __init__(self, path):
+        filesystem = get_filesystem(os.path.dirname(os.path.abspath(path)))
+        if filesystem in network_filesystems:
+            raise ValueError(f"The fit store {path} is on a {filesystem} file system, give a path on a local disk")
+        self.path = path
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(path, timeout=600)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fits (digest TEXT, lim INTEGER, method TEXT, mu REAL,'
+                                    ' sigma REAL, converged INTEGER, nfev INTEGER, n_obs INTEGER,'
+                                    ' PRIMARY KEY (digest, lim, method))')
+
+    def get(self, digests, limit, method):
+        # one row of mu, sigma, converged and function calls per digest, and whether it was found
+        rows = {}
+        for start in range(0, len(digests), max_query_digests):
+            chunk = list(digests[start:start + max_query_digests])
+            query = 'SELECT digest, mu, sigma, converged, nfev FROM fits WHERE lim = ? AND method = ? AND digest IN' \
+                    f' ({", ".join("?" * len(chunk))})'
+            for digest, *values in self.connection.execute(query, [limit, method] + chunk):
+                rows[digest] = values
+        params = np.array([rows.get(digest, [np.nan, np.nan, 0, 0]) for digest in digests],
+                          dtype=float).reshape(len(digests), 4)
+        return params, np.array([digest in rows for digest in digests], dtype=bool)
+
+    def put(self, digests, limit, method, params, n_obs):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        [(digest, limit, method, None if np.isnan(mu) else float(mu),
+                                          None if np.isnan(sigma) else float(sigma), int(converged), int(nfev),
+                                          int(n)) for digest, (mu, sigma, converged, nfev), n in
+                                         zip(digests, params, n_obs)])
+
+
+stores = {}
+
+
+def get_store(path):
+    # one connection per store and process, connections can't be shared with forked workers
+    store = stores.get(path)
+    if store is None or store.pid != os.getpid():
+        store = stores[path] = FitStore(path)
+    return store
@@ -0,0 +1,274 @@
+import argparse
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import executors
+import instrumentation
+from histograms import get_source_codes
+from partials import atomic_write
+from tweets_multiprocessing import (add_batch_arguments, get_batch_rows, get_files, iter_batch, multiprocess_batches,
+                                    set_batch_memory)
+
+from constants import first_day, last_day, lang_sorted, max_n_chars, source_types, switch_date
+
+
+class HistogramCube:
+    # dense counts of tweets indexed by (date, lang, source_type, n_chars)
+    def __init__(self, counts, dates, langs=lang_sorted, sources=source_types):
+        self.counts = counts
+        self.dates = pd.DatetimeIndex(dates)
+        self.langs = list(langs)
+        self.sources = list(sources)
+        self._prefix = None
+
+    @property
+    def prefix(self):
+        # counts of all days before each date, with one more row for all days, so that the counts of any range of
+        # days are the difference of two rows
+        if self._prefix is None:
+            self._prefix = np.zeros((len(self.dates) + 1,) + self.counts.shape[1:], dtype=np.uint64)
+            np.cumsum(self.counts, axis=0, dtype=np.uint64, out=self._prefix[1:])
+        return self._prefix
+
+    def get_position(self, date, default):
+        # row of prefix with the counts of the days before date
+        return default if date is None else self.dates.searchsorted(pd.Timestamp(date))
+
+    def window_counts(self, start=None, end=None):
+        # counts of [start, end) indexed by (lang, source_type, n_chars)
+        first, last = self.get_position(start, 0), self.get_position(end, len(self.dates))
+        return self.prefix[max(first, last)] - self.prefix[first]
+
+    def select(self, start=None, end=None, langs=None, sources=None):
+        date_mask = np.ones(len(self.dates), dtype=bool)
+        if start is not None:
+            date_mask &= self.dates >= pd.Timestamp(start)
+        if end is not None:
+            date_mask &= self.dates < pd.Timestamp(end)
+        langs = sorted(self.langs if langs is None else set(langs) & set(self.langs))
+        sources = sorted(self.sources if sources is None else sources)
+        counts = self.counts[date_mask][:, [self.langs.index(lang) for lang in langs]]
+        counts = counts[:, :, [self.sources.index(source) for source in sources]]
+        return counts, self.dates[date_mask], langs, sources
+
+    def daily_histograms(self, before_switch, langs, sources=None, groupby_cols='date'):
+        # same output as daily_cramming.process_batch_daily over all batches
+        if before_switch:
+            counts, dates, langs, source_names = self.select(end=switch_date, langs=langs,
+                                                             sources=get_source_types(sources))
+        else:
+            counts, dates, langs, source_names = self.select(start=switch_date, langs=langs,
+                                                             sources=get_source_types(sources))
+        # reorder to (source_type, lang, date, n_chars) and sum out what is not grouped on
+        counts = counts.transpose(2, 1, 0, 3)
+        if groupby_cols == 'date':
+            counts = counts.sum(axis=(0, 1), keepdims=True)
+        elif groupby_cols == 'lang':
+            counts = counts.sum(axis=0, keepdims=True)
+        elif groupby_cols == 'source':
+            counts = counts.sum(axis=1, keepdims=True)
+        s, l, d = np.nonzero(counts.sum(axis=3))
+        index = pd.MultiIndex.from_arrays([np.array(source_names)[s], np.array(langs)[l], dates[d].date],
+                                          names=['source_type', 'lang', 'created_at'])
+        if groupby_cols == 'date':
+            index = index.droplevel([0, 1])
+        elif groupby_cols == 'lang':
+            index = index.droplevel(0)
+        elif groupby_cols == 'source':
+            index = index.droplevel(1)
+        return pd.DataFrame(counts[s, l, d].astype(np.int64), index=index, columns=range(max_n_chars + 1))
+
+    def period_histograms(self, start, end, langs, sources='allowed'):
+        # same output as scatter_per_lang.process_batch_period over all batches
+        langs = sorted(set(langs) & set(self.langs))
+        counts = self.window_counts(start, end)[[self.langs.index(lang) for lang in langs]]
+        counts = counts[:, [self.sources.index(source) for source in get_source_types(sources)]].sum(axis=1)
+        present = counts.sum(axis=1) > 0
+        return pd.DataFrame(counts[present].astype(np.int64), index=pd.Index(np.array(langs)[present], name='lang'),
+                            columns=range(max_n_chars + 1))
+
+    def rolling_histograms(self, days, langs, sources='allowed', start=None, end=None):
+        # histogram per language of the days days up to and including every date of [start, end)
+        langs = sorted(set(langs) & set(self.langs))
+        prefix = self.prefix[:, [self.langs.index(lang) for lang in langs]]
+        prefix = prefix[:, :, [self.sources.index(source) for source in get_source_types(sources)]].sum(axis=2)
+        last = np.arange(self.get_position(start, 0), self.get_position(end, len(self.dates))) + 1
+        counts = (prefix[last] - prefix[np.maximum(last - days, 0)]).transpose(1, 0, 2)
+        l, d = np.nonzero(counts.sum(axis=2))
+        index = pd.MultiIndex.from_arrays([np.array(langs)[l], self.dates[last - 1][d].date], names=['lang', 'created_at'])
+        return pd.DataFrame(counts[l, d].astype(np.int64), index=index, columns=range(max_n_chars + 1))
+
+
+def get_source_types(sources):
+    if sources == 'allowed':
+        return ['mobile', 'web']
+    return source_types
+
+
+def get_dates():
+    return pd.date_range(first_day, last_day, freq='D')
+
+
+def process_batch_cube(file):
+    # tweets created outside of the cube dates are not read
+    counts = [cube_cells(df) for df in iter_batch(file, columns=['lang', 'n_chars', "source", "created_at"],
+                                                   langs=lang_sorted, start=first_day,
+                                                   end=get_dates()[-1] + pd.Timedelta(days=1))]
+    # chunks of a streamed batch share cells
+    return counts[0] if len(counts) == 1 else pd.concat(counts).groupby(level=0).sum()
+
+
+def cube_cells(df):
+    with instrumentation.stage('aggregate', rows=len(df)) as record:
+        df = df.loc[(df.n_chars >= 0) & (df.n_chars <= max_n_chars)]
+        source = get_source_codes(df.source)
+        date = (df.created_at.values.astype('datetime64[D]') - np.datetime64(first_day, 'D')).astype(np.int64)
+        lang = pd.Categorical(df.lang, categories=lang_sorted).codes
+        # flat position of every tweet in the cube
+        cell = np.ravel_multi_index((date, lang, source, df.n_chars.values),
+                                    (len(get_dates()), len(lang_sorted), len(source_types), max_n_chars + 1))
+        counts = pd.Series(cell).value_counts()
+        record['histograms'] = len(counts)
+    return counts
+
+
+def build_cube(files):
+    counts = np.zeros((len(get_dates()), len(lang_sorted), len(source_types), max_n_chars + 1), dtype=np.uint32)
+    flat = counts.reshape(-1)
+
+    def add(output):
+        flat[output.index.values] += output.values.astype(np.uint32)
+
+    multiprocess_batches(process_batch_cube, files, merge=add)
+    return HistogramCube(counts, get_dates())
+
+
+def save_cube(cube, path, **arrays):
+    np.savez_compressed(path, counts=cube.counts, dates=cube.dates.values.astype('datetime64[D]'),
+                        langs=np.array(cube.langs), sources=np.array(cube.sources), **arrays)
+
+
+def load_cube(path):
+    # a directory of shards is merged first
+    if os.path.isdir(path):
+        return merge_shards(path)
+    with np.load(path, allow_pickle=False) as data:
+        return HistogramCube(data['counts'], data['dates'], data['langs'].tolist(), data['sources'].tolist())
+
+
+def parse_shard(text):
+    # i/N with i from 1 to N
+    match = re.fullmatch(r'(\d+)/(\d+)', text)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"Expected i/N with 1 <= i <= N, got {text}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_shard_files(files, shard, n_shards, rows):
+    # every batch goes to the shard with the fewest tweets so far, largest batches first, so that all invocations
+    # compute the same shards from the same files
+    shard_rows = [0] * n_shards
+    shard_files = [[] for _ in range(n_shards)]
+    for i in sorted(range(len(files)), key=lambda i: (-rows[i], files[i])):
+        smallest = shard_rows.index(min(shard_rows))
+        shard_rows[smallest] += rows[i]
+        shard_files[smallest].append(files[i])
+    return sorted(shard_files[shard - 1])
+
+
+def get_shard_path(directory, shard, n_shards):
+    return os.path.join(directory, f"shard-{shard}-of-{n_shards}.npz")
+
+
+def save_shard(cube, files, directory, shard, n_shards):
+    # renamed into place once complete, a shard file that exists is always whole
+    os.makedirs(directory, exist_ok=True)
+    atomic_write(get_shard_path(directory, shard, n_shards),
+                 lambda path: save_cube(cube, path, batches=np.array([os.path.basename(file) for file in files])))
+
+
+def get_shard_paths(directory):
+    # completed shards by number, and how many shards there are
+    shards, n_shards = {}, set()
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        match = re.fullmatch(r'shard-(\d+)-of-(\d+)\.npz', name)
+        if match is not None:
+            shards[int(match.group(1))] = os.path.join(directory, name)
+            n_shards.add(int(match.group(2)))
+    if len(n_shards) > 1:
+        raise ValueError(f"Shards of different runs in {directory}: {sorted(n_shards)} shards")
+    return shards, n_shards.pop() if n_shards else 0
+
+
+def merge_shards(directory, wait=0, poll=10):
+    # cube of all batches from the shards saved in directory, waits up to wait seconds for missing shards
+    deadline = time.time() + wait
+    while True:
+        shards, n_shards = get_shard_paths(directory)
+        missing = [shard for shard in range(1, n_shards + 1) if shard not in shards]
+        if n_shards and not missing:
+            break
+        if time.time() >= deadline:
+            raise FileNotFoundError(f"Missing shards {missing or 'all'} in {directory}")
+        time.sleep(poll)
+    counts, batches = None, []
+    for shard in range(1, n_shards + 1):
+        with np.load(shards[shard], allow_pickle=False) as data:
+            counts = data['counts'].copy() if counts is None else counts + data['counts']
+            dates, langs, sources = data['dates'], data['langs'].tolist(), data['sources'].tolist()
+            batches.extend(data['batches'].tolist())
+    if len(set(batches)) != len(batches):
+        raise ValueError(f"Batches counted by more than one shard in {directory}")
+    print(f"Merged {n_shards} shards of {len(batches)} batches")
+    return HistogramCube(counts, dates, langs, sources)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Scan every batch once and save daily counts of tweet lengths per language and source type,'
+                    ' all scripts in src can then run from the cube with --cube instead of scanning the batches')
+
+    parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
+    parser.add_argument('--save-path', help='Where to save the cube, default: ../data/measurements',
+                        default='../data/measurements')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Only scan the i-th of N disjoint subsets of the batches, given as i/N, and save its counts'
+                             ' to --shard-dir, the shards are merged by --merge or by any script run with --cube on'
+                             ' the shard directory')
+    parser.add_argument('--shard-dir', default=None,
+                        help='Directory shared by the shards, default: shards in the save path')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the shards of --shard-dir into the cube instead of scanning batches')
+    parser.add_argument('--wait', type=float, default=0,
+                        help='With --merge, how many seconds to wait for shards that are not done yet, default: 0')
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
+
+    args = parser.parse_args()
+    executors.initialize(args.n_cores, args.executor)
+    set_batch_memory(args.batch_memory)
+    instrumentation.initialize(args.instrument)
+    shard_dir = os.path.join(args.save_path, 'shards') if args.shard_dir is None else args.shard_dir
+
+    files = get_files()
+    if args.shard is not None:
+        files = get_shard_files(files, *args.shard, get_batch_rows(files))
+        print(f"Counting tweet lengths per day, language and source type in {len(files)} batches of the shard...")
+        cube = build_cube(files)
+
+        print("Saving shard...")
+        save_shard(cube, files, shard_dir, *args.shard)
+    else:
+        if args.merge:
+            print("Merging shards...")
+            cube = merge_shards(shard_dir, wait=args.wait)
+        else:
+            print("Counting tweet lengths per day, language and source type...")
+            cube = build_cube(files)
+
+        print("Saving to file...")
+        save_cube(cube, os.path.join(args.save_path, "histogram_cube.npz"))
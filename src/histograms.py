@@ -0,0 +1,173 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+from constants import max_n_chars, mobile_sources, source_types, web_sources
+
+
+def bincount_histograms(keys, n_chars, n_keys):
+    # one row of counts of tweets with 0 to max_n_chars characters per key
+    in_range = (keys >= 0) & (n_chars >= 0) & (n_chars <= max_n_chars)
+    cells = keys[in_range] * (max_n_chars + 1) + n_chars[in_range]
+    return np.bincount(cells, minlength=n_keys * (max_n_chars + 1)).reshape(n_keys, max_n_chars + 1)
+
+
+def groupby_histograms(groupby_obj, n_chars):
+    with instrumentation.stage('aggregate', rows=len(n_chars)) as record:
+        keys = groupby_obj.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        counts = bincount_histograms(keys, np.asarray(n_chars, dtype=np.int64), groupby_obj.ngroups)
+        record['histograms'] = len(counts)
+    return pd.DataFrame(counts, index=get_plain_index(groupby_obj.size().index), columns=range(max_n_chars + 1))
+
+
+def get_plain_index(index):
+    # categorical keys give categorical levels, which can't be merged across batches with other categories
+    if isinstance(index, pd.MultiIndex):
+        return index.set_levels([get_plain_index(level) for level in index.levels])
+    if isinstance(index, pd.CategoricalIndex):
+        return index.astype(index.categories.dtype)
+    return index
+
+
+def convert_source(text):
+    if text in mobile_sources:
+        return 'mobile'
+    elif text in web_sources:
+        return 'web'
+    else:
+        return 'automated'
+
+
+def get_source_codes(sources):
+    # classify every distinct source once, the codes are positions in source_types
+    if isinstance(sources.dtype, pd.CategoricalDtype):
+        codes, uniques = sources.cat.codes.to_numpy(), sources.cat.categories
+    else:
+        codes, uniques = pd.factorize(sources)
+    # missing sources get code -1 which picks the trailing 'automated'
+    unique_codes = np.array([source_types.index(convert_source(source)) for source in uniques]
+                            + [source_types.index('automated')])
+    return unique_codes[codes]
+
+
+def classify_sources(sources):
+    return np.array(source_types, dtype=object)[get_source_codes(sources)]
+
+
+class Histograms:
+    # integer counts of tweets with 0 to max_n_chars characters, one row per key of index
+    def __init__(self, counts, index):
+        self.counts = np.asarray(counts)
+        self.index = index if isinstance(index, pd.Index) else pd.Index(index)
+        if self.counts.shape != (len(self.index), max_n_chars + 1):
+            raise ValueError("Expected one row of counts for 0 to max_n_chars characters per key")
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls(frame.reindex(columns=range(max_n_chars + 1), fill_value=0).to_numpy(dtype=np.uint64), frame.index)
+
+    def to_frame(self):
+        return pd.DataFrame(self.counts.astype(np.int64), index=self.index, columns=range(max_n_chars + 1))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        # same keys as frame.loc, a partial key of a MultiIndex drops the matched levels
+        positions = pd.Series(np.arange(len(self.index)), index=self.index).loc[key]
+        if not isinstance(positions, pd.Series):
+            return self.counts[positions]
+        return Histograms(self.counts[positions.to_numpy()], positions.index)
+
+    def __add__(self, other):
+        index = self.index.union(other.index)
+        counts = np.zeros((len(index), max_n_chars + 1), dtype=np.uint64)
+        counts[index.get_indexer(self.index)] += self.counts.astype(np.uint64)
+        counts[index.get_indexer(other.index)] += other.counts.astype(np.uint64)
+        return Histograms(counts, index)
+
+    def densities(self, limit):
+        # one row of densities at 1..limit characters per key
+        counts = self.counts[:, 1:limit + 1].astype(float)
+        totals = counts.sum(axis=1, keepdims=True)
+        return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+    def save(self, path):
+        # a directory of .npy files that can be memory mapped, or a single compressed .npz file
+        arrays = get_index_arrays(self.index)
+        if path.endswith('.npz'):
+            np.savez_compressed(path, counts=self.counts, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+            np.save(os.path.join(path, 'counts.npy'), self.counts)
+            np.savez(os.path.join(path, 'index.npz'), **arrays)
+
+
+def load_histograms(path, mmap_mode=None):
+    if path.endswith('.npz'):
+        with np.load(path, allow_pickle=False) as data:
+            return Histograms(data['counts'], get_index(data))
+    with np.load(os.path.join(path, 'index.npz'), allow_pickle=False) as data:
+        index = get_index(data)
+    return Histograms(np.load(os.path.join(path, 'counts.npy'), mmap_mode=mmap_mode), index)
+
+
+def get_index_arrays(index):
+    # levels of the index as arrays numpy can save without pickling, days are saved as datetime64
+    arrays = {'names': np.array(['' if name is None else name for name in index.names])}
+    for i in range(index.nlevels):
+        values = index.get_level_values(i)
+        if len(values) and isinstance(values[0], datetime.date):
+            arrays[f'level_{i}'] = np.array(values, dtype='datetime64[D]')
+        elif pd.api.types.is_numeric_dtype(values):
+            arrays[f'level_{i}'] = values.to_numpy()
+        else:
+            arrays[f'level_{i}'] = values.to_numpy(dtype=str)
+    return arrays
+
+
+def get_index(data):
+    names = [name if name else None for name in data['names'].tolist()]
+    levels = []
+    for i in range(len(names)):
+        values = data[f'level_{i}']
+        levels.append(pd.to_datetime(values).date if values.dtype.kind == 'M' else values)
+    if len(levels) == 1:
+        return pd.Index(levels[0], name=names[0])
+    return pd.MultiIndex.from_arrays(levels, names=names)
+
+
+class HistogramAccumulator:
+    # dense sum of the histograms of many batches, one row of counts per key, rows for new keys are
+    # added as batches arrive and the counts array doubles when it is full
+    def __init__(self, capacity=1024):
+        self.counts = np.zeros((capacity, max_n_chars + 1), dtype=np.uint64)
+        self.index = None
+
+    def add(self, hists):
+        if not isinstance(hists, Histograms):
+            hists = Histograms.from_frame(hists)
+        if self.index is None:
+            self.index = hists.index[:0]
+        positions = self.index.get_indexer(hists.index)
+        new = positions == -1
+        if new.any():
+            positions[new] = np.arange(len(self.index), len(self.index) + new.sum())
+            self.index = self.index.append(hists.index[new])
+            if len(self.index) > len(self.counts):
+                counts = np.zeros((max(2 * len(self.counts), len(self.index)), max_n_chars + 1), dtype=np.uint64)
+                counts[:len(self.counts)] = self.counts
+                self.counts = counts
+        self.counts[positions] += hists.counts.astype(np.uint64)
+
+    def to_histograms(self):
+        if self.index is None:
+            return Histograms(np.zeros((0, max_n_chars + 1), dtype=np.uint64), pd.Index([]))
+        order = self.index.argsort()
+        return Histograms(self.counts[:len(self.index)][order], self.index[order])
+
+    def to_frame(self):
+        return self.to_histograms().to_frame()
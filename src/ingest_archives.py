@@ -0,0 +1,178 @@
+import argparse
+import bz2
+import glob
+import gzip
+import html
+import json
+import os
+import tarfile
+
+import numpy as np
+import pandas as pd
+import executors
+import instrumentation
+from histogram_cube import HistogramCube, cube_cells, get_dates, load_cube, save_cube
+from partials import atomic_write
+from tweets_multiprocessing import multiprocess_batches
+
+from constants import lang_sorted, max_n_chars, source_types
+
+# tweets parsed before their cells are counted, the memory of a worker doesn't depend on the size of the members
+chunk_tweets = 100000
+archive_suffixes = ('.json', '.json.bz2', '.json.gz', '.jsonl', '.jsonl.bz2', '.jsonl.gz')
+
+
+def list_members(path):
+    # (archive, member name, tar header) of every json file in a tar archive, or the file itself
+    if not tarfile.is_tarfile(path):
+        return [(path, os.path.basename(path), None)]
+    # tars can be gzip or bz2 compressed as a whole, as well as hold bz2 or gz json files
+    with tarfile.open(path, 'r:*') as tar:
+        return [(path, member.name, member) for member in tar
+                if member.isfile() and member.name.endswith(archive_suffixes)]
+
+
+def open_member(archive, name, member):
+    if member is None:
+        raw, tar = open(archive, 'rb'), None
+    else:
+        tar = tarfile.open(archive, 'r:*')
+        # seeks to the member with its header instead of reading the archive up to it, a compressed tar is only
+        # decompressed up to the member
+        raw = tar.extractfile(member)
+    if name.endswith('.bz2'):
+        stream = bz2.open(raw, 'rt', encoding='utf-8')
+    elif name.endswith('.gz'):
+        stream = gzip.open(raw, 'rt', encoding='utf-8')
+    else:
+        stream = (line.decode('utf-8') for line in raw)
+    return stream, [raw] + ([tar] if tar is not None else [])
+
+
+def parse_tweet(line):
+    # (created_at, lang, source, n_chars) of a tweet, None for deletions, retweets and broken lines,
+    # n_chars is the number of characters of the displayed text of the full tweet, without the leading mentions of
+    # replies and the trailing media links
+    try:
+        tweet = json.loads(line)
+    except ValueError:
+        return None
+    if 'created_at' not in tweet or 'retweeted_status' in tweet:
+        return None
+    full = tweet.get('extended_tweet', tweet)
+    # the text is html escaped but display_text_range counts the characters of the unescaped text
+    text = html.unescape(full.get('full_text', tweet.get('text')) or '')
+    start, end = full.get('display_text_range', tweet.get('display_text_range', (0, len(text))))
+    return tweet['created_at'], tweet.get('lang'), tweet.get('source'), len(text[start:end])
+
+
+def tweet_frame(tweets):
+    # the columns of the lengths dataset, only the tweets that fit in the cube
+    df = pd.DataFrame(tweets, columns=['created_at', 'lang', 'source', 'n_chars'])
+    # utc so that the column is tz-aware even when none of the dates of the chunk can be parsed
+    df['created_at'] = pd.to_datetime(df.created_at, format='%a %b %d %H:%M:%S %z %Y', utc=True, errors='coerce')
+    df = df.dropna(subset=['created_at'])
+    df['created_at'] = df.created_at.dt.tz_convert(None)
+    dates = get_dates()
+    return df.loc[df.lang.isin(lang_sorted) & (df.created_at >= dates[0])
+                  & (df.created_at < dates[-1] + pd.Timedelta(days=1)) & (df.n_chars <= max_n_chars)]
+
+
+def iter_tweet_frames(task):
+    # the number of tweets parsed and the frame of those kept, chunk_tweets at a time
+    stream, handles = open_member(*task)
+    try:
+        tweets = []
+        for line in stream:
+            tweet = parse_tweet(line)
+            if tweet is not None:
+                tweets.append(tweet)
+            if len(tweets) == chunk_tweets:
+                yield len(tweets), tweet_frame(tweets)
+                tweets = []
+        if tweets:
+            yield len(tweets), tweet_frame(tweets)
+    finally:
+        for handle in reversed(handles):
+            handle.close()
+
+
+def process_member(task):
+    # counts per cell of the cube of one archive member, as process_batch_cube for a batch
+    counts = pd.Series(dtype=np.int64)
+    with instrumentation.stage('read', member=task[1]) as record:
+        record.update(rows_read=0, rows_kept=0)
+        for n_tweets, df in iter_tweet_frames(task):
+            counts = counts.add(cube_cells(df), fill_value=0)
+            record['rows_read'] += n_tweets
+            record['rows_kept'] += len(df)
+    return counts.astype(np.int64)
+
+
+def get_member_key(task):
+    # archives with the same name in different directories are different archives, the archives must stay where
+    # they were ingested from for their members to be skipped
+    return f"{os.path.abspath(task[0])}/{task[1]}"
+
+
+def get_member_size(task):
+    archive, _, member = task
+    return os.path.getsize(archive) if member is None else member.size
+
+
+def ingest(tasks, cube):
+    # adds the tweets of every member to the counts of the cube as soon as the member is read
+    counts = cube.counts.astype(np.uint64)
+    flat = counts.reshape(-1)
+
+    def add(output):
+        flat[output.index.values] += output.values.astype(np.uint64)
+
+    multiprocess_batches(process_member, tasks, merge=add, rows=[get_member_size(task) for task in tasks])
+    if counts.max(initial=0) < 2**32:
+        counts = counts.astype(np.uint32)
+    return HistogramCube(counts, cube.dates, cube.langs, cube.sources)
+
+
+def load_ingested(path):
+    # members already added to the cube at path
+    if not os.path.exists(path):
+        return []
+    with np.load(path, allow_pickle=False) as data:
+        return data['ingested'].tolist() if 'ingested' in data else []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Count tweet lengths per day, language and source type straight from raw tweet archives (tar'
+                    ' archives, possibly gzip or bz2 compressed, of bz2 or gz json files, or such files themselves)'
+                    ' into the histogram cube, without writing the lengths dataset first')
+
+    parser.add_argument('archives', nargs='+', help='Archives or json files, glob patterns are expanded')
+    parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
+    parser.add_argument('--cube', default='../data/measurements/histogram_cube.npz',
+                        help='Cube the counts are added to, created if it does not exist, members added before are'
+                             ' skipped, default: ../data/measurements/histogram_cube.npz')
+    executors.add_executor_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
+
+    args = parser.parse_args()
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+
+    paths = sorted(path for pattern in args.archives for path in (glob.glob(pattern) or [pattern]))
+    ingested = load_ingested(args.cube)
+    done = set(ingested)
+    tasks = [task for path in paths for task in list_members(path) if get_member_key(task) not in done]
+    print(f"Reading {len(tasks)} new archive members...")
+    if os.path.exists(args.cube):
+        cube = load_cube(args.cube)
+    else:
+        cube = HistogramCube(np.zeros((len(get_dates()), len(lang_sorted), len(source_types), max_n_chars + 1),
+                                      dtype=np.uint32), get_dates())
+    cube = ingest(tasks, cube)
+
+    print("Saving to file...")
+    # the counts and the members they include are replaced together
+    ingested = np.array(ingested + [get_member_key(task) for task in tasks], dtype=str)
+    atomic_write(args.cube, lambda path: save_cube(cube, path, ingested=ingested))
@@ -0,0 +1,147 @@
+import atexit
+import json
+import os
+import pickle
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import executors
+
+# json-lines log of the stages, None when instrumentation is off
+log_path = None
+# stages of the batch a worker is processing in its batch_stages, stages outside of a batch are logged right away,
+# per thread for the thread executor
+worker = threading.local()
+
+
+def add_instrumentation_arguments(parser):
+    parser.add_argument('--instrument', default=None,
+                        help='Log the time, rows and memory of every batch and stage as json lines to this file and'
+                             ' summarize them at the end of the run')
+
+
+def initialize(path):
+    # must be called before the executor is created so that the workers log too
+    set_log_path(path)
+    executors.add_worker_setting(set_log_path, path)
+    if path is not None:
+        open(path, 'w').close()
+        atexit.register(summarize, path)
+
+
+def set_log_path(path):
+    global log_path
+    log_path = path
+
+
+def enabled():
+    return log_path is not None
+
+
+def peak_rss_mb():
+    # peak of the process over its lifetime, not of the batch it is running, in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb():
+    # memory the process holds now, None where /proc isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return None
+
+
+def log(record):
+    with open(log_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def stage(name, **fields):
+    # the stage can add fields to the record it is given, e.g. how many rows it kept
+    record = dict(event='stage', stage=name, **fields)
+    if not enabled():
+        yield record
+        return
+    start = time.perf_counter()
+    yield record
+    record['seconds'] = time.perf_counter() - start
+    if getattr(worker, 'batch_stages', None) is not None:
+        worker.batch_stages.append(record)
+    else:
+        record['pid'] = os.getpid()
+        log(record)
+
+
+def run_instrumented(args):
+    # runs func on a batch in a worker and returns its output with the record of the batch
+    func, file = args
+    worker.batch_stages = []
+    start = time.perf_counter()
+    peak_before = peak_rss_mb()
+    output = func(file)
+    seconds = time.perf_counter() - start
+    # incremental runs pass (func, file) to their own runner
+    name = file[1] if isinstance(file, tuple) else file
+    record = {'event': 'batch', 'batch': os.path.basename(name) if isinstance(name, str) else str(name),
+              'seconds': seconds, 'stages': worker.batch_stages,
+              'output_bytes': len(pickle.dumps(output, protocol=-1)), 'pid': os.getpid()}
+    # the worker's peak only grows with the batches that need more memory than all the previous ones of the worker
+    record['worker_peak_rss_mb'] = peak_rss_mb()
+    record['peak_rss_growth_mb'] = record['worker_peak_rss_mb'] - peak_before
+    record['rss_mb'] = rss_mb()
+    worker.batch_stages = None
+    return output, record
+
+
+def read_log(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(path):
+    records = read_log(path)
+    batches = [record for record in records if record['event'] == 'batch']
+    if batches:
+        seconds = np.array([batch['seconds'] for batch in batches])
+        print(f"{len(batches)} batches: {seconds.sum():.1f} s in total, median {np.median(seconds):.2f} s,"
+              f" max {seconds.max():.2f} s ({seconds.max() / np.median(seconds):.1f}x the median),"
+              f" max worker peak RSS {max(batch['worker_peak_rss_mb'] for batch in batches):.0f} MB,"
+              f" {sum(batch['output_bytes'] for batch in batches) / 2 ** 20:.1f} MB returned")
+        print("Slowest batches:")
+        for batch in sorted(batches, key=lambda batch: -batch['seconds'])[:5]:
+            stages = ', '.join(f"{stage['stage']} {stage['seconds']:.2f} s" for stage in batch['stages'])
+            print(f"  {batch['batch']}: {batch['seconds']:.2f} s ({stages})")
+        print("Batches that raised the peak RSS of their worker the most:")
+        for batch in sorted(batches, key=lambda batch: -batch['peak_rss_growth_mb'])[:5]:
+            print(f"  {batch['batch']}: +{batch['peak_rss_growth_mb']:.0f} MB,"
+                  f" peak {batch['worker_peak_rss_mb']:.0f} MB")
+    pools = [record for record in records if record['event'] == 'pool']
+    for pool in pools:
+        print(f"Pool of {pool['n_cores']} cores on {pool['n_batches']} batches: {pool['seconds']:.1f} s")
+    if pools and batches:
+        # low when a few batches keep the pool waiting
+        available = sum(pool['seconds'] * min(pool['n_cores'], pool['n_batches']) for pool in pools)
+        print(f"Workers busy {100 * sum(batch['seconds'] for batch in batches) / available:.0f}% of the time")
+    stages = [stage for batch in batches for stage in batch['stages']]
+    stages += [record for record in records if record['event'] == 'stage']
+    if stages:
+        print("Stages:")
+    for name in sorted(set(stage['stage'] for stage in stages)):
+        selected = [stage for stage in stages if stage['stage'] == name]
+        seconds = np.array([stage['seconds'] for stage in selected])
+        line = f"  {name}: {len(selected)} times, {seconds.sum():.2f} s in total, max {seconds.max():.2f} s"
+        if 'rows_read' in selected[0]:
+            line += f", {sum(stage['rows_read'] for stage in selected)} rows read," \
+                    f" {sum(stage['rows_kept'] for stage in selected)} kept"
+        if 'fits' in selected[0]:
+            fits = sum(stage['fits'] for stage in selected)
+            line += f", {fits / seconds.sum() if seconds.sum() else 0:.0f} fits/s," \
+                    f" {sum(stage['failed'] for stage in selected)} failed," \
+                    f" {sum(stage['nfev'] for stage in selected) / max(fits, 1):.1f} function calls per fit"
+        print(line)
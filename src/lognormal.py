@@ -1,5 +1,150 @@
 import numpy as np
+from scipy.special import ndtr
 
 def lognormal_func(x, mu, sigma) :
     return 1 / (np.sqrt(2 * np.pi) * sigma * x) * np.exp(-((np.log(x) - mu)**2) \
-                                                         / (2 * sigma**2))
\ No newline at end of file
+                                                         / (2 * sigma**2))
+
+
+def lognormal_jacobian(x, mu, sigma):
+    f = lognormal_func(x, mu, sigma)
+    log_x = np.log(x) - mu
+    return f, f * log_x / sigma**2, f * (log_x**2 / sigma**3 - 1 / sigma)
+
+
+def solve_step(a11, a12, a22, g1, g2, damping):
+    # (J'J + damping * I) step = -J'r for every row
+    b11, b22 = a11 + damping, a22 + damping
+    det = b11 * b22 - a12**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (-g1 * b22 + g2 * a12) / det, (-g2 * b11 + g1 * a12) / det
+
+
+def fit_lognormal_batch(density, p0=(1, 1), ftol=1.49012e-08, xtol=1.49012e-08, maxfev=600):
+    # least squares fit of lognormal_func to every row of density (N x limit, densities at 1..limit) with a
+    # vectorized version of the scaled trust region Levenberg-Marquardt from MINPACK that curve_fit uses,
+    # with the same default tolerances and number of function calls for two parameters
+    density = np.asarray(density, dtype=float)
+    n_rows, limit = density.shape
+    x = np.arange(1, limit + 1, dtype=float)
+    # p0 is either one (mu, sigma) pair or one pair per row
+    p0 = np.broadcast_to(np.asarray(p0, dtype=float), (n_rows, 2))
+    mu, sigma = p0[:, 0].copy(), p0[:, 1].copy()
+    converged = np.zeros(n_rows, dtype=bool)
+    nfev = np.ones(n_rows, dtype=int)
+    # rows without any tweet can't be fitted
+    active = np.flatnonzero(density.sum(axis=1) > 0)
+
+    f, d_mu, d_sigma = lognormal_jacobian(x, mu[active, None], sigma[active, None])
+    residuals = f - density[active]
+    # scaling of the parameters and trust region radius as in MINPACK
+    scale_mu, scale_sigma = np.linalg.norm(d_mu, axis=1), np.linalg.norm(d_sigma, axis=1)
+    scale_mu[scale_mu == 0], scale_sigma[scale_sigma == 0] = 1, 1
+    radius = 100 * np.hypot(scale_mu * mu[active], scale_sigma * sigma[active])
+    radius[radius == 0] = 100
+    while len(active):
+        ssr = np.sum(residuals**2, axis=1)
+        # normal equations in scaled parameters
+        a11 = np.sum(d_mu**2, axis=1) / scale_mu**2
+        a12 = np.sum(d_mu * d_sigma, axis=1) / (scale_mu * scale_sigma)
+        a22 = np.sum(d_sigma**2, axis=1) / scale_sigma**2
+        g1, g2 = np.sum(d_mu * residuals, axis=1) / scale_mu, np.sum(d_sigma * residuals, axis=1) / scale_sigma
+        # Gauss-Newton step, or the damped step that ends on the trust region boundary
+        step_mu, step_sigma = solve_step(a11, a12, a22, g1, g2, 0)
+        step_norm = np.hypot(step_mu, step_sigma)
+        damping = np.zeros(len(active))
+        outside = ~np.isfinite(step_norm) | (step_norm > 1.1 * radius)
+        if outside.any():
+            low, high = np.zeros(outside.sum()), np.hypot(g1, g2)[outside] / radius[outside]
+            for _ in range(60):
+                middle = (low + high) / 2
+                norm = np.hypot(*solve_step(a11[outside], a12[outside], a22[outside], g1[outside], g2[outside], middle))
+                too_long = ~np.isfinite(norm) | (norm > radius[outside])
+                low, high = np.where(too_long, middle, low), np.where(too_long, high, middle)
+            damping[outside] = high
+            step_mu[outside], step_sigma[outside] = solve_step(a11[outside], a12[outside], a22[outside],
+                                                               g1[outside], g2[outside], high)
+            step_norm = np.hypot(step_mu, step_sigma)
+        radius = np.where(nfev[active] == 1, np.minimum(radius, step_norm), radius)
+
+        step_mu, step_sigma = step_mu / scale_mu, step_sigma / scale_sigma
+        new_mu, new_sigma = mu[active] + step_mu, sigma[active] + step_sigma
+        new_ssr = np.sum((lognormal_func(x, new_mu[:, None], new_sigma[:, None]) - density[active])**2, axis=1)
+        nfev[active] += 1
+        predicted_ssr = np.sum((residuals + d_mu * step_mu[:, None] + d_sigma * step_sigma[:, None])**2, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            actual_reduction = np.where(np.isfinite(new_ssr) & (new_ssr < 100 * ssr), 1 - new_ssr / ssr, -1)
+            predicted_reduction = 1 - predicted_ssr / ssr
+            ratio = np.where(predicted_reduction != 0, actual_reduction / predicted_reduction, 0)
+
+        # update the trust region radius
+        shrink = ratio <= 0.25
+        radius = np.where(shrink, 0.5 * np.minimum(radius, 10 * step_norm), radius)
+        radius = np.where(~shrink & ((ratio >= 0.75) | (damping == 0)), 2 * step_norm, radius)
+
+        accepted = ratio >= 1e-4
+        rows = active[accepted]
+        mu[rows], sigma[rows] = new_mu[accepted], new_sigma[accepted]
+        # an accepted step needs a new jacobian, curve_fit estimates it with two more function calls
+        nfev[rows] += 2
+
+        parameters_norm = np.hypot(scale_mu * mu[active], scale_sigma * sigma[active])
+        done = (ssr == 0) \
+            | ((np.abs(actual_reduction) <= ftol) & (predicted_reduction <= ftol) & (0.5 * ratio <= 1)) \
+            | (radius <= xtol * parameters_norm)
+        converged[active[done]] = True
+        keep = ~done & (nfev[active] < maxfev) & np.isfinite(radius)
+
+        refresh = accepted[keep]
+        f, d_mu, d_sigma, residuals = f[keep], d_mu[keep], d_sigma[keep], residuals[keep]
+        scale_mu, scale_sigma, radius = scale_mu[keep], scale_sigma[keep], radius[keep]
+        active = active[keep]
+        if refresh.any():
+            rows = active[refresh]
+            f[refresh], d_mu[refresh], d_sigma[refresh] = lognormal_jacobian(x, mu[rows, None], sigma[rows, None])
+            residuals[refresh] = f[refresh] - density[rows]
+            scale_mu[refresh] = np.maximum(scale_mu[refresh], np.linalg.norm(d_mu[refresh], axis=1))
+            scale_sigma[refresh] = np.maximum(scale_sigma[refresh], np.linalg.norm(d_sigma[refresh], axis=1))
+    mu[~converged] = np.nan
+    sigma[~converged] = np.nan
+    return mu, sigma, converged, nfev
+
+
+def log_moments(density):
+    # mu and sigma with the mean and variance of log(x) of every row of density (N x limit, densities at 1..limit),
+    # the truncation at limit is ignored which is close enough to start a fit from
+    density = np.asarray(density, dtype=float)
+    log_x = np.log(np.arange(1, density.shape[1] + 1))
+    totals = density.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu = density @ log_x / totals
+        sigma = np.sqrt(np.maximum(density @ log_x**2 / totals - mu**2, 0))
+    # rows without any tweet or with a single length start from curve_fit's default
+    undefined = ~np.isfinite(mu) | ~np.isfinite(sigma) | (sigma == 0)
+    return np.where(undefined, 1, mu), np.where(undefined, 1, sigma)
+
+
+def fit_lognormal_moments(density, n_iterations=50):
+    # closed form estimate of mu and sigma for every row of density (N x limit, densities at 1..limit): the
+    # log-moments of the histogram are those of a normal truncated to [log(0.5), log(limit + 0.5)], solved for
+    # the untruncated mu and sigma by fixed point iterations, returns the same tuple as fit_lognormal_batch
+    density = np.asarray(density, dtype=float)
+    mean, std = log_moments(density)
+    lower, upper = np.log(0.5), np.log(density.shape[1] + 0.5)
+    mu, sigma = mean.copy(), std.copy()
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(n_iterations):
+            a, b = (lower - mu) / sigma, (upper - mu) / sigma
+            mass = ndtr(b) - ndtr(a)
+            pdf_a, pdf_b = np.exp(-a**2 / 2) / np.sqrt(2 * np.pi), np.exp(-b**2 / 2) / np.sqrt(2 * np.pi)
+            shift = (pdf_a - pdf_b) / mass
+            shrink = 1 + (a * pdf_a - b * pdf_b) / mass - shift**2
+            sigma = std / np.sqrt(shrink)
+            mu = mean - sigma * shift
+    # keep the plain log-moments where the correction doesn't settle
+    settled = np.isfinite(mu) & np.isfinite(sigma) & (sigma > 0)
+    mu, sigma = np.where(settled, mu, mean), np.where(settled, sigma, std)
+    converged = density.sum(axis=1) > 0
+    mu[~converged] = np.nan
+    sigma[~converged] = np.nan
+    return mu, sigma, converged, np.zeros(len(density), dtype=int)
@@ -1,9 +1,69 @@
+import os
+import warnings
+
 import numpy as np
+import pandas as pd
 from scipy.optimize import curve_fit
+from scipy.special import ndtri
 from scipy.stats import lognorm
 
+import instrumentation
 from constants import cramming_threshold_after, cramming_threshold_before
-from lognormal import lognormal_func
+from fit_executor import get_ranges, map_ranges
+from histograms import Histograms
+from fit_store import get_store, histogram_digests, is_node_local
+from lognormal import fit_lognormal_batch, fit_lognormal_moments, log_moments, lognormal_func
+
+fit_methods = ['curve_fit', 'batch', 'fast']
+# resampled counts drawn and fitted at once, histograms x replicates x limit
+max_bootstrap_size = 2 ** 24
+# function calls after which curve_fit gives up on two parameters
+max_curve_fit_nfev = 600
+
+
+def add_fit_arguments(parser):
+    parser.add_argument('--fit-method', choices=fit_methods, default='curve_fit',
+                        help='How to fit the lognormals: curve_fit one histogram at a time, batch for all histograms'
+                             ' at once with a vectorized Levenberg-Marquardt or fast from the log-moments of the'
+                             ' histograms below the cramming threshold without any fit, default: curve_fit')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='Fit every series of daily histograms in time order, starting each fit from the parameters'
+                             ' of the previous day or from the log-moments of the histogram, ignored when the'
+                             ' histograms are not per day, e.g. per language or per window')
+    parser.add_argument('--compare-fits', action='store_true',
+                        help='Also fit the histograms with curve_fit and report how far the parameters and measures of'
+                             ' the chosen fit method are from it')
+    parser.add_argument('--fit-store', default=None,
+                        help='sqlite file where the fitted lognormals of every script are kept, so that each distinct'
+                             ' histogram is only fitted once, it must be on a local disk and not in a shard directory'
+                             ' shared by other nodes, default: fits.sqlite in --partials if given and on a local disk')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help='Add lower and upper columns with the confidence interval of every measure from this many'
+                             ' multinomial resamples of every histogram, default: 0, no intervals')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence level of the bootstrap intervals, default: 0.95')
+
+
+def fit_options(args):
+    # keyword arguments of measures() and num_chars_frame() chosen with add_fit_arguments
+    return {'method': args.fit_method, 'warm_start': args.warm_start, 'compare': args.compare_fits,
+            'store': get_store_path(args), 'n_replicates': args.bootstrap, 'confidence': args.confidence}
+
+
+def get_store_path(args):
+    # runs with partials keep their fits next to them, unless the partials are on a network file system
+    if args.fit_store is None and args.partials is not None:
+        path = os.path.join(args.partials, 'fits.sqlite')
+        if is_node_local(path):
+            return path
+        print(f"Not keeping the fits in {path}, it isn't on a local disk")
+        return None
+    # the shards of other nodes are merged through a shared directory, the store can't be shared with them
+    cube = getattr(args, 'cube', None)
+    if args.fit_store is not None and cube is not None and os.path.isdir(cube) and \
+            os.path.realpath(args.fit_store).startswith(os.path.join(os.path.realpath(cube), '')):
+        raise ValueError(f"The fit store {args.fit_store} is in the shard directory {cube}, give a path on a local disk")
+    return args.fit_store
 
 
 def cramming_140_wrapper(day_hist):
@@ -14,24 +74,427 @@ def cramming_280_wrapper(day_hist):
     return measure(day_hist=day_hist, measurement_at=280, measure='cramming')
 
 
-def measure(day_hist, measurement_at, measure='runover', probabilities=[0.95]):
-    limit = 280
-    cramming_start = cramming_threshold_after
-    if measurement_at == 140:
-        limit = 140
-        cramming_start = cramming_threshold_before
+def get_hist(day_hist, limit):
+    # day_hist is either a row of counts indexed by n_chars or a row holding them as a hist_chars Series
+    if isinstance(day_hist, pd.DataFrame) or 'hist_chars' in day_hist.index:
+        day_hist = day_hist.hist_chars.sort_index()[:limit]
     # fill missing values
-    day_hist = day_hist.hist_chars.sort_index()[:limit]\
-        .reindex(index=range(1, limit+1), fill_value=0).fillna(0)
-    density = (day_hist / np.sum(day_hist))
-    # fit lognormal
+    return day_hist.reindex(index=range(1, limit+1), fill_value=0).fillna(0).astype(float)
+
+
+def get_counts(hists, limit):
+    # one row of counts at 1..limit characters per histogram in hists
+    if isinstance(hists, Histograms):
+        return hists.counts[:, 1:limit+1].astype(float)
+    if 'hist_chars' in hists:
+        counts = np.array([get_hist(day_hist, limit).values for _, day_hist in hists.iterrows()])
+    else:
+        counts = hists.reindex(columns=range(1, limit+1), fill_value=0).fillna(0).to_numpy(dtype=float)
+    return counts.reshape(len(hists), limit)
+
+
+def normalize(counts):
+    totals = counts.sum(axis=1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+
+def get_densities(hists, limit):
+    # one row of densities at 1..limit characters per histogram in hists
+    return normalize(get_counts(hists, limit))
+
+
+def bootstrap_counts(counts, n_replicates, rng):
+    # n_replicates multinomial resamples of every histogram with as many tweets, the replicates of a histogram
+    # are consecutive rows
+    counts = np.rint(counts).astype(np.int64)
+    totals = counts.sum(axis=1)
+    probabilities = counts / np.maximum(totals, 1)[:, None]
+    resamples = rng.multinomial(totals, probabilities, size=(n_replicates, len(counts)))
+    return resamples.transpose(1, 0, 2).reshape(-1, counts.shape[1]).astype(float)
+
+
+def get_limits(measurement_at):
+    if measurement_at == 140:
+        return 140, cramming_threshold_before
+    return 280, cramming_threshold_after
+
+
+def curve_fit_wrapper(density, p0=None):
+    # same fit as in measure() for one row of densities, also returns the number of function calls
     if density.sum() == 0.0:
-        return np.nan
+        return pd.Series([np.nan, np.nan, False, 0])
     try:
-        mu, sigma = curve_fit(lognormal_func, range(1, limit+1), density)[0]
+        params, _, infodict, _, _ = curve_fit(lognormal_func, range(1, len(density)+1), density, p0=p0,
+                                              full_output=True)
     except RuntimeError:
         print("Couldn't fit the model, max function call exceeded")
+        return pd.Series([np.nan, np.nan, False, max_curve_fit_nfev])
+    return pd.Series([params[0], params[1], True, infodict['nfev']])
+
+
+def curve_fit_rows(density):
+    return np.array([curve_fit_wrapper(row).to_numpy(dtype=float) for row in density]).reshape(len(density), 4)
+
+
+def batch_fit_rows(density):
+    return np.column_stack(fit_lognormal_batch(density)).astype(float)
+
+
+def seeded_batch_fit_rows(rows):
+    # the first two columns are the mu and sigma every row starts from
+    return np.column_stack(fit_lognormal_batch(rows[:, 2:], p0=rows[:, :2])).astype(float)
+
+
+def curve_fit_series(density):
+    # curve_fit the rows of one series in time order, each fit starts where the last successful one ended
+    params = []
+    previous = None
+    for row in density:
+        p0 = previous if previous is not None else [p[0] for p in log_moments(row[None, :])]
+        mu, sigma, converged, nfev = curve_fit_wrapper(row, p0=p0)
+        if converged:
+            previous = [mu, sigma]
+        params.append([mu, sigma, converged, nfev])
+    return np.array(params, dtype=float).reshape(len(density), 4)
+
+
+def batch_fit_series(density, series_rows):
+    # fit the n-th day of every series at once, each fit starts where the last successful one of its series ended
+    mu, sigma = np.full(len(density), np.nan), np.full(len(density), np.nan)
+    converged, nfev = np.zeros(len(density), dtype=bool), np.zeros(len(density), dtype=int)
+    n_days = max(len(rows) for rows in series_rows)
+    days = np.full((len(series_rows), n_days), -1)
+    for i, rows in enumerate(series_rows):
+        days[i, :len(rows)] = rows
+    previous = np.full((len(series_rows), 2), np.nan)
+    for day in range(n_days):
+        has_day = days[:, day] >= 0
+        rows = days[has_day, day]
+        p0 = np.column_stack(log_moments(density[rows]))
+        seeded = np.isfinite(previous[has_day, 0])
+        p0[seeded] = previous[has_day][seeded]
+        mu[rows], sigma[rows], converged[rows], nfev[rows] = fit_lognormal_batch(density[rows], p0=p0)
+        previous[np.flatnonzero(has_day)[converged[rows]]] = np.column_stack((mu[rows], sigma[rows]))[converged[rows]]
+    return mu, sigma, converged, nfev
+
+
+def is_time_index(index):
+    # the last level holds days, as dates or timestamps, e.g. not languages or windows
+    return pd.api.types.infer_dtype(index.get_level_values(-1)) in ('date', 'datetime', 'datetime64')
+
+
+def get_series(index):
+    # rows of every series of histograms in time order, days are the last level of the index and
+    # the other levels (source, lang) identify the series
+    days = pd.factorize(index.get_level_values(-1), sort=True)[0]
+    if index.nlevels > 1:
+        series = pd.factorize(index.droplevel(-1))[0]
+    else:
+        series = np.zeros(len(index), dtype=int)
+    order = np.lexsort((days, series))
+    return np.split(order, np.flatnonzero(np.diff(series[order])) + 1)
+
+
+def split_params(params):
+    return params[:, 0], params[:, 1], params[:, 2].astype(bool), params[:, 3].astype(int)
+
+
+def fit_params(density, index, cramming_start, method='curve_fit', warm_start=False):
+    # one row of mu, sigma, converged and function calls per row of density
+    if method == 'fast':
+        # the pile up of crammed tweets just below the limit would bias the moments
+        return np.column_stack(fit_lognormal_moments(density[:, :cramming_start])).astype(float)
+    if warm_start and method == 'curve_fit':
+        # every series is one range of rows once they are sorted by series and day
+        series_rows = get_series(index)
+        order = np.concatenate(series_rows)
+        ends = np.cumsum([len(rows) for rows in series_rows])
+        ranges = zip(np.concatenate(([0], ends[:-1])), ends)
+        params = np.empty((len(density), 4))
+        params[order] = map_ranges(curve_fit_series, density[order], ranges, 4)
+        return params
+    if warm_start:
+        return np.column_stack(batch_fit_series(density, get_series(index))).astype(float)
+    fit_rows = curve_fit_rows if method == 'curve_fit' else batch_fit_rows
+    return map_ranges(fit_rows, density, get_ranges(len(density)), 4)
+
+
+class LognormalFit:
+    # lognormals fitted once to every histogram, all measures are derived from the same parameters
+    def __init__(self, density, limit, cramming_start, index, method='curve_fit', warm_start=False, compare=False,
+                 store=None, counts=None, n_replicates=0, confidence=0.95, seed=0):
+        self.density = density
+        self.limit = limit
+        self.cramming_start = cramming_start
+        self.index = index
+        self.method = method
+        # only series of daily histograms are fitted in time order, other histograms are unrelated to their neighbours
+        self.warm_start = warm_start and index is not None and is_time_index(index)
+        if warm_start and not self.warm_start:
+            print("Ignoring --warm-start, the histograms aren't series of days")
+        self.compare = compare
+        # path of a FitStore, only histograms that aren't in it yet are fitted
+        self.store = store
+        self.counts = density if counts is None else counts
+        self.params = None
+        # bootstrap replicates per histogram for the confidence intervals
+        self.n_replicates = n_replicates
+        self.confidence = confidence
+        self.seed = seed
+        # fitted parameters of the replicates, shared by all measures
+        self.replicate_params = None
+
+    def fit(self):
+        # the lognormals are only fitted when a measure needs them
+        if self.params is None:
+            params = np.empty((len(self.density), 4))
+            to_fit = np.ones(len(self.density), dtype=bool)
+            if self.store is not None:
+                store = get_store(self.store)
+                digests = histogram_digests(self.counts)
+                params, found = store.get(digests, self.limit, self.store_method)
+                to_fit = ~found
+                print(f"Reusing the stored fits of {found.sum()} histograms")
+            if to_fit.any():
+                with instrumentation.stage('fit', method=self.store_method, limit=self.limit) as record:
+                    params[to_fit] = fit_params(self.density[to_fit], self.index[to_fit], self.cramming_start,
+                                                method=self.method, warm_start=self.warm_start)
+                    if instrumentation.enabled():
+                        failed = ~params[to_fit, 2].astype(bool) & (self.density[to_fit].sum(axis=1) > 0)
+                        record.update(fits=int(to_fit.sum()), reused=int((~to_fit).sum()), failed=int(failed.sum()),
+                                      nfev=int(params[to_fit, 3].sum()))
+                if self.store is not None:
+                    store.put([digest for digest, fitted in zip(digests, to_fit) if fitted], self.limit,
+                              self.store_method, params[to_fit], self.counts[to_fit].sum(axis=1))
+            self.params = split_params(params)
+            self.report(to_fit)
+            if self.compare and self.method != 'curve_fit':
+                self.report_deviation()
+        return self.params
+
+    def report(self, fitted):
+        _, _, converged, nfev = self.params
+        failed = ~converged & (self.density.sum(axis=1) > 0) & fitted
+        print(f"Fitted {fitted.sum()} histograms with {nfev[fitted].sum()} function calls"
+              f" ({nfev[fitted].mean() if fitted.any() else 0:.1f} per histogram), {failed.sum()} fits failed")
+
+    def report_deviation(self):
+        reference = LognormalFit(self.density, self.limit, self.cramming_start, self.index, warm_start=self.warm_start,
+                                 store=self.store, counts=self.counts)
+        both = self.converged & reference.converged
+        print(f"Deviation of the {self.method} fits from curve_fit on {both.sum()} histograms"
+              " (median, 95th percentile, max of absolute differences):")
+        for name, values, reference_values in [('mu', self.mu, reference.mu), ('sigma', self.sigma, reference.sigma),
+                                               ('runover', self.runover(), reference.runover()),
+                                               ('cramming', self.cramming(), reference.cramming())]:
+            deviation = np.abs(values - reference_values)[both]
+            if len(deviation):
+                print(f"  {name}: {np.median(deviation):.3g}, {np.percentile(deviation, 95):.3g},"
+                      f" {deviation.max():.3g}")
+
+    @property
+    def store_method(self):
+        # warm started fits can end slightly apart from cold ones
+        return f"{self.method}{'_warm' if self.warm_start else ''}"
+
+    @property
+    def mu(self):
+        return self.fit()[0]
+
+    @property
+    def sigma(self):
+        return self.fit()[1]
+
+    @property
+    def converged(self):
+        return self.fit()[2]
+
+    @property
+    def nfev(self):
+        return self.fit()[3]
+
+    def runover(self):
+        return 1 - lognorm.cdf(self.limit, s=self.sigma, scale=np.exp(self.mu), loc=0)
+
+    def cramming(self, start=None):
+        # start is the number of characters after which cramming is measured, by default the threshold of the limit
+        start = self.cramming_start if start is None else start
+        lognormal = lognormal_func(np.arange(1, self.limit+1), self.mu[:, None], self.sigma[:, None])
+        return np.abs(np.sum(self.density[:, start:] - lognormal[:, start:], axis=1))
+
+    def num_chars(self, probabilities=[0.95]):
+        # quantile function of every lognormal at every probability, the same as lognorm.ppf without its
+        # per call checks: exp(mu + sigma * quantile of the standard normal), NaN like lognorm.ppf for the fits that
+        # aren't lognormals, curve_fit can end with a negative sigma
+        mu = np.where((self.sigma > 0) & np.isfinite(self.mu), self.mu, np.nan)
+        return np.exp(mu[:, None] + self.sigma[:, None] * ndtri(np.asarray(probabilities, dtype=float))[None, :])
+
+    def empirical_fraction(self, x=140):
+        # fraction of tweets longer than x characters, doesn't need the fit
+        return self.density[:, x:].sum(axis=1)
+
+    def values(self, name, probabilities=[0.95]):
+        if name == 'runover':
+            return self.runover()
+        elif name == 'cramming':
+            return self.cramming()
+        elif name == 'num_chars':
+            return self.num_chars(probabilities)
+        elif name == 'empirical fraction':
+            return self.empirical_fraction()
+        raise ValueError("Unknown measure")
+
+    def estimate(self, name, probabilities=[0.95]):
+        # the measure and the lower and upper bounds of its bootstrap interval, None without replicates
+        values = self.values(name, probabilities)
+        if not self.n_replicates:
+            return values, None, None
+        quantiles = [(1 - self.confidence) / 2, (1 + self.confidence) / 2]
+        with warnings.catch_warnings():
+            # histograms without any converged replicate
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanquantile(self.bootstrap_values(name, probabilities), quantiles, axis=1)
+        return values, lower, upper
+
+    def resamples(self):
+        # the same resamples of the histograms every time, a few histograms at a time
+        rng = np.random.default_rng(self.seed)
+        chunk_size = max(1, max_bootstrap_size // (self.n_replicates * self.limit))
+        for start in range(0, len(self.counts), chunk_size):
+            stop = min(start + chunk_size, len(self.counts))
+            yield start, stop, bootstrap_counts(self.counts[start:stop], self.n_replicates, rng)
+
+    def bootstrap_params(self):
+        # all replicates of a chunk of histograms are fitted in one call, with the batch fit unless the
+        # method is fast as fitting them one by one would take n_replicates times longer, the replicates
+        # start from the fit of their histogram which they are close to
+        if self.replicate_params is None:
+            params = [np.empty((0, 4))]
+            for start, stop, counts in self.resamples():
+                density = normalize(counts)
+                if self.method == 'fast':
+                    params.append(fit_params(density, None, self.cramming_start, method='fast'))
+                    continue
+                p0 = np.repeat(np.column_stack((self.mu[start:stop], self.sigma[start:stop])), self.n_replicates,
+                               axis=0)
+                unfitted = ~np.isfinite(p0).all(axis=1)
+                p0[unfitted] = np.column_stack(log_moments(density[unfitted]))
+                rows = np.column_stack((p0, density))
+                params.append(map_ranges(seeded_batch_fit_rows, rows, get_ranges(len(rows)), 4))
+            self.replicate_params = np.concatenate(params)
+        return self.replicate_params
+
+    def bootstrap_values(self, name, probabilities=[0.95]):
+        # the measure for every replicate, one row of n_replicates values per histogram, the replicates are only
+        # fitted for the measures that need the fit, as in values()
+        params = None if name == 'empirical fraction' else self.bootstrap_params()
+        values = []
+        for start, stop, counts in self.resamples():
+            replicates = LognormalFit(normalize(counts), self.limit, self.cramming_start, None, counts=counts)
+            if params is not None:
+                replicates.params = split_params(params[start * self.n_replicates:stop * self.n_replicates])
+            replicate_values = replicates.values(name, probabilities)
+            values.append(replicate_values.reshape((stop - start, self.n_replicates) + replicate_values.shape[1:]))
+        return np.concatenate(values) if values else np.empty((0, self.n_replicates))
+
+
+def fit(hists, measurement_at, **options):
+    # options of LognormalFit, see fit_options
+    limit, cramming_start = get_limits(measurement_at)
+    counts = get_counts(hists, limit)
+    return LognormalFit(normalize(counts), limit, cramming_start, hists.index, counts=counts, **options)
+
+
+def add_estimate(columns, column, estimate):
+    # the values of a measure as column, and the bounds of their intervals as <column>_lower and <column>_upper
+    # when there are bootstrap replicates
+    values, lower, upper = estimate
+    columns[column] = values
+    if lower is not None:
+        columns[f'{column}_lower'], columns[f'{column}_upper'] = lower, upper
+
+
+def measures(hists, measurement_at, names, probabilities=[0.95], **options):
+    # every measure in names from a single fit per histogram, one column per measure
+    # and one column per probability for num_chars, each followed by its bounds with bootstrap replicates
+    fits = fit(hists, measurement_at, **options)
+    columns = {}
+    for name in names:
+        if name == 'num_chars':
+            estimate = fits.estimate(name, probabilities)
+            for i, probability in enumerate(probabilities):
+                add_estimate(columns, probability, [None if values is None else values[:, i] for values in estimate])
+        else:
+            add_estimate(columns, name, fits.estimate(name))
+    return pd.DataFrame(columns, index=hists.index)
+
+
+def measures_per_group(hists, by, measurement_at, names, **options):
+    # measures() of every group of hists by the column by, e.g. per source type, as one frame per column of
+    # measures() with one column per group, the layout of hists.groupby(by).apply(measure).T
+    groups = {key: measures(group, measurement_at, names, **options)
+              for key, group in hists.groupby(by, observed=True)}
+    columns = next(iter(groups.values())).columns
+    return {column: pd.DataFrame({key: df[column] for key, df in groups.items()}).rename_axis(columns=by)
+            for column in columns}
+
+
+def lay_out_bounds(lay_out, n_replicates):
+    # the frame of lay_out(''), which arranges columns of measures such as 'runover' + suffix into the output with the
+    # values last, followed by their bounds arranged the same way by lay_out('_lower') and lay_out('_upper') when
+    # there are bootstrap replicates
+    df = lay_out('')
+    column = df.columns[-1]
+    if n_replicates:
+        for bound in ['lower', 'upper']:
+            df[f'{column}_{bound}'] = lay_out(f'_{bound}').iloc[:, -1].to_numpy()
+    return df
+
+
+def measure_columns(df, name, column):
+    # the column of measure name in a frame of measures() and its bounds if any, renamed after column
+    columns = [c for c in [name, f'{name}_lower', f'{name}_upper'] if c in df]
+    return df[columns].rename(columns=lambda c: column + c[len(name):])
+
+
+def num_chars_frame(hists, measurement_at, probabilities=[0.95], **options):
+    # num_chars of every histogram at every probability in long format, one row per probability and histogram
+    # ordered by probability, with the bounds of the intervals as num_chars_lower and num_chars_upper
+    estimate = fit(hists, measurement_at, **options).estimate('num_chars', probabilities)
+    columns = {'probability': np.repeat(np.asarray(probabilities, dtype=float), len(hists))}
+    add_estimate(columns, 'num_chars', [None if values is None else values.T.reshape(-1) for values in estimate])
+    return pd.DataFrame(columns, index=hists.index[np.tile(np.arange(len(hists)), len(probabilities))])
+
+
+def measure(day_hist, measurement_at, measure='runover', probabilities=[0.95], method='curve_fit', store=None):
+    limit, cramming_start = get_limits(measurement_at)
+    day_hist = get_hist(day_hist, limit)
+    density = (day_hist / np.sum(day_hist))
+    # fit lognormal
+    if density.sum() == 0.0:
         return np.nan
+    # a histogram fitted before by any script is read from the store
+    if store is not None:
+        digests = histogram_digests([day_hist.values])
+        params, found = get_store(store).get(digests, limit, method)
+    if store is not None and found[0]:
+        mu, sigma, converged, _ = params[0]
+        if not converged:
+            return np.nan
+    else:
+        try:
+            if method == 'fast':
+                mu, sigma = [p[0] for p in fit_lognormal_moments(density.values[None, :cramming_start])[:2]]
+            else:
+                mu, sigma = curve_fit(lognormal_func, range(1, limit+1), density)[0]
+        except RuntimeError:
+            print("Couldn't fit the model, max function call exceeded")
+            if store is not None:
+                get_store(store).put(digests, limit, method, [[np.nan, np.nan, False, max_curve_fit_nfev]],
+                                     [day_hist.sum()])
+            return np.nan
+        if store is not None:
+            get_store(store).put(digests, limit, method, [[mu, sigma, True, 0]], [day_hist.sum()])
     if measure == 'runover':
         return 1 - lognorm.cdf(limit, s=sigma, scale=np.exp(mu), loc=0)
     elif measure == 'cramming':
@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import pandas as pd
+import pyarrow.dataset as ds
+
+output_formats = ['csv', 'parquet', 'both']
+# columns the parquet measurements are partitioned by when they have them
+partition_cols = ['measure', 'measurement_at']
+date_cols = ['created_at', 'date', 'start', 'end']
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--output-format', choices=output_formats, default='csv',
+                        help='Save the measurements as csv.gz, as parquet partitioned by measure and measurement_at'
+                             ' or both, default: csv')
+
+
+def to_typed_frame(df, index=True):
+    # dates as datetime64 and text as categories so that they don't need to be parsed when read back
+    if index:
+        df = df.reset_index()
+    df = df.copy()
+    for column in df.columns:
+        if column in date_cols:
+            df[column] = pd.to_datetime(df[column])
+        elif not pd.api.types.is_numeric_dtype(df[column]) and column not in partition_cols:
+            df[column] = df[column].astype('category')
+    df.columns = [str(column) for column in df.columns]
+    return df
+
+
+def write_parquet(df, path, index=True):
+    df = to_typed_frame(df, index=index)
+    partitions = [column for column in partition_cols if column in df.columns]
+    # replace the whole dataset at once so that no part file of a previous run is left in a partition
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    if partitions:
+        df.to_parquet(tmp_path, partition_cols=partitions, index=False)
+    else:
+        os.makedirs(tmp_path)
+        df.to_parquet(os.path.join(tmp_path, 'part-0.parquet'), index=False)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def write_measurements(df, save_path, name, output_format='csv', index=True):
+    if output_format in ['csv', 'both']:
+        df.to_csv(os.path.join(save_path, f'{name}.csv.gz'), index=index)
+    if output_format in ['parquet', 'both']:
+        write_parquet(df, os.path.join(save_path, name), index=index)
+
+
+def get_filters(partitions):
+    # one partition value or a list of values per partition column
+    return [(column, 'in', list(values)) if isinstance(values, (list, tuple, set)) else (column, '==', values)
+            for column, values in partitions.items()] or None
+
+
+def load_measurements(name, path='../data/measurements', columns=None, index_col='created_at', **partitions):
+    # measurements saved by write_measurements, e.g. load_measurements('daily_measures_per_lang_per_source',
+    # columns=['lang', 'measurement'], measure='cramming', measurement_at=140) only reads that partition,
+    # the csv.gz file is read when there is no parquet dataset
+    dataset_path = os.path.join(path, name)
+    if os.path.isdir(dataset_path):
+        if columns is not None and index_col in ds.dataset(dataset_path, partitioning='hive').schema.names:
+            columns = [index_col] + [column for column in columns if column != index_col]
+        df = pd.read_parquet(dataset_path, columns=columns, filters=get_filters(partitions))
+        # partitions are read back as categories
+        if 'measurement_at' in df.columns:
+            df['measurement_at'] = df['measurement_at'].astype(int)
+    else:
+        df = pd.read_csv(dataset_path + '.csv.gz')
+        for column, values in partitions.items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            df = df[df[column].isin(values)]
+        if index_col in df.columns:
+            df[index_col] = pd.to_datetime(df[index_col])
+        if columns is not None:
+            df = df[[index_col] + [column for column in columns if column != index_col]
+                    if index_col in df.columns else columns]
+    if index_col in df.columns:
+        df = df.set_index(index_col)
+    return df
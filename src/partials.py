@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import sys
+
+from histograms import Histograms, load_histograms
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def atomic_write(path, write):
+    # write to a temporary file renamed over path so that a killed run never leaves half a file
+    root, extension = os.path.splitext(path)
+    tmp_path = f'{root}.{os.getpid()}.tmp{extension}'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_func_name(func):
+    # the wrappers of different scripts share names, the script tells them apart
+    module = sys.modules[func.__module__]
+    script = os.path.splitext(os.path.basename(getattr(module, '__file__', func.__module__)))[0]
+    return f'{script}.{func.__name__}'
+
+
+def get_file_entry(path):
+    # manifest entry of a batch, taken before it is scanned so that a batch changed during the scan is scanned again
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash(path)}
+
+
+def run_batch(args):
+    # the batch is hashed in the worker that scans it rather than in the process merging the outputs
+    func, file = args
+    entry = get_file_entry(file)
+    return file, func(file), entry
+
+
+class PartialStore:
+    # histograms of every batch for one wrapper, with a manifest of the batches they were computed from
+    def __init__(self, directory, name):
+        self.directory = os.path.join(directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def get_partial_path(self, file):
+        return os.path.join(self.directory, os.path.basename(file) + '.npz')
+
+    def is_current(self, file):
+        entry = self.manifest.get(file)
+        if entry is None or not os.path.exists(self.get_partial_path(file)):
+            return False
+        stat = os.stat(file)
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return True
+        # a batch that was only touched or copied again doesn't need to be rescanned
+        if entry['size'] == stat.st_size and entry['hash'] == file_hash(file):
+            entry['mtime'] = stat.st_mtime
+            self.save_manifest()
+            return True
+        return False
+
+    def load(self, file):
+        return load_histograms(self.get_partial_path(file))
+
+    def save(self, file, hists, entry=None):
+        # entry from get_file_entry, the batch is hashed here when it isn't given
+        if not isinstance(hists, Histograms):
+            hists = Histograms.from_frame(hists)
+        atomic_write(self.get_partial_path(file), hists.save)
+        self.manifest[file] = get_file_entry(file) if entry is None else entry
+        self.save_manifest()
+
+    def save_manifest(self):
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(self.manifest, f, indent=1)
+        atomic_write(self.manifest_path, write)
+
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from constants import max_n_chars
+from fit_store import histogram_digests
+from histogram_cube import get_source_types, load_cube
+from measure import LognormalFit, fit_params, get_counts, get_limits, normalize, split_params
+
+
+class LRUCache:
+    # least recently used entries are dropped once their sizes add up to more than max_size
+    def __init__(self, max_size, size=lambda value: 1):
+        self.max_size = max_size
+        self.size = size
+        self.entries = OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.total -= self.size(self.entries.pop(key))
+        self.entries[key] = value
+        self.total += self.size(value)
+        # the newest entry is kept even when it is larger than max_size on its own
+        while self.total > self.max_size and len(self.entries) > 1:
+            _, dropped = self.entries.popitem(last=False)
+            self.total -= self.size(dropped)
+
+    def info(self):
+        return {'entries': len(self.entries), 'size': self.total, 'hits': self.hits, 'misses': self.misses}
+
+
+class MeasureQuery:
+    # measures of the tweets of any languages, sources and days answered from the histogram cube in the running
+    # process, e.g. in a notebook:
+    #   q = MeasureQuery('../data/measurements/histogram_cube.npz')
+    #   q.measure('cramming', at=140, lang='en', source='mobile', start='2017-01-01', end='2017-11-01', freq='D')
+    # the histograms of recent queries and the fits of recent histograms are kept in bounded LRU caches, so that
+    # repeated or overlapping queries don't aggregate or fit again
+    def __init__(self, cube, method='batch', histogram_cache_mb=256, fit_cache_size=1000000):
+        self.cube = load_cube(cube) if isinstance(cube, str) else cube
+        self.method = method
+        self.histograms_cache = LRUCache(histogram_cache_mb * 2**20, size=lambda hists: hists.values.nbytes)
+        # one row of mu, sigma, converged and function calls per histogram
+        self.fits_cache = LRUCache(fit_cache_size)
+
+    def get_langs(self, lang):
+        # None for all languages, one language or a list of them
+        langs = self.cube.langs if lang is None else [lang] if isinstance(lang, str) else list(lang)
+        unknown = set(langs) - set(self.cube.langs)
+        if unknown:
+            raise ValueError(f"Unknown languages {sorted(unknown)}")
+        return sorted(langs)
+
+    def get_sources(self, source):
+        # None for all source types, 'allowed' for web and mobile, one source type or a list of them
+        if source is None or source == 'allowed':
+            return get_source_types(source)
+        sources = [source] if isinstance(source, str) else list(source)
+        unknown = set(sources) - set(self.cube.sources)
+        if unknown:
+            raise ValueError(f"Unknown source types {sorted(unknown)}")
+        return sorted(sources)
+
+    def get_windows(self, start, end, freq):
+        # [start, end) of every period of freq between start and end, or of the whole range without freq
+        first, last = self.cube.dates[0], self.cube.dates[-1] + pd.Timedelta(days=1)
+        start = first if start is None else max(pd.Timestamp(start), first)
+        end = last if end is None else min(pd.Timestamp(end), last)
+        if end <= start:
+            raise ValueError(f"No day of the cube between {start.date()} and {end.date()}")
+        if freq is None:
+            return pd.DatetimeIndex([start]), pd.DatetimeIndex([end])
+        periods = pd.period_range(start, end - pd.Timedelta(days=1), freq=freq)
+        starts = pd.DatetimeIndex(periods.start_time)
+        ends = pd.DatetimeIndex(periods.end_time.normalize() + pd.Timedelta(days=1))
+        return starts.where(starts >= start, start), ends.where(ends <= end, end)
+
+    def histograms(self, lang=None, source=None, start=None, end=None, freq=None):
+        # counts per window of the tweets of the languages and sources, indexed by the start of the windows
+        langs, sources = self.get_langs(lang), self.get_sources(source)
+        key = (tuple(langs), tuple(sources), start and str(start), end and str(end), freq)
+        hists = self.histograms_cache.get(key)
+        if hists is None:
+            starts, ends = self.get_windows(start, end, freq)
+            # two rows of the prefix sums per window, only for the languages and sources of the query
+            lang_positions = [self.cube.langs.index(lang) for lang in langs]
+            source_positions = [self.cube.sources.index(source) for source in sources]
+            prefix = self.cube.prefix
+            counts = (prefix[np.ix_(self.cube.dates.searchsorted(ends), lang_positions, source_positions)]
+                      - prefix[np.ix_(self.cube.dates.searchsorted(starts), lang_positions, source_positions)])
+            hists = pd.DataFrame(counts.sum(axis=(1, 2)).astype(np.int64), index=pd.Index(starts, name='start'),
+                                 columns=range(max_n_chars + 1))
+            self.histograms_cache.put(key, hists)
+        return hists
+
+    def fit(self, counts, limit, cramming_start):
+        # fitted parameters of every row of counts, only the histograms that aren't cached are fitted, at once
+        keys = [(digest, limit, self.method) for digest in histogram_digests(counts)]
+        params = np.empty((len(keys), 4))
+        missing = []
+        for i, key in enumerate(keys):
+            cached = self.fits_cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                params[i] = cached
+        if missing:
+            params[missing] = fit_params(normalize(counts[missing]), None, cramming_start, method=self.method)
+            for i in missing:
+                self.fits_cache.put(keys[i], params[i])
+        return params
+
+    def measure(self, name, at=280, lang=None, source=None, start=None, end=None, freq=None, probabilities=[0.95]):
+        # one of 'runover', 'cramming', 'num_chars' or 'empirical fraction' measured at the limit at, per period
+        # of freq as a Series (a DataFrame with one column per probability for num_chars), or over the whole range
+        # without freq
+        hists = self.histograms(lang=lang, source=source, start=start, end=end, freq=freq)
+        limit, cramming_start = get_limits(at)
+        counts = get_counts(hists, limit)
+        fits = LognormalFit(normalize(counts), limit, cramming_start, hists.index, counts=counts)
+        if name != 'empirical fraction':
+            fits.params = split_params(self.fit(counts, limit, cramming_start))
+        values = fits.values(name, probabilities)
+        if name == 'num_chars':
+            values = pd.DataFrame(values, index=hists.index, columns=probabilities)
+        else:
+            values = pd.Series(values, index=hists.index, name=name)
+        return values.iloc[0] if freq is None else values
+
+    def cache_info(self):
+        return {'histograms': self.histograms_cache.info(), 'fits': self.fits_cache.info()}
@@ -1,14 +1,18 @@
-import os
-from functools import reduce
-
 import argparse
 import pandas as pd
-from measure import measure
-from pandarallel import pandarallel
-from tweets_multiprocessing import get_files, multiprocess_batches
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, measure_columns, measures
+import executors
+import instrumentation
+from tweets_multiprocessing import add_batch_arguments, get_files, get_histograms, scan_batch, set_batch_memory
+from histogram_cube import load_cube
+from histograms import groupby_histograms
 
 from constants import allowed_sources, lang_sorted
 
+before_period = ('2017-01-01', '2017-11-01')
+after_period = ('2019-01-01', '2019-11-01')
+
 
 def before_period_wrapper(x):
     return process_batch_period(x, before_switch=True)
@@ -19,24 +23,12 @@ def after_period_wrapper(x):
 
 
 def process_batch_period(file, before_switch):
-    df = pd.read_parquet(file, columns=['lang', 'n_chars', "source", "created_at"])
-    df = df.loc[df['lang'].isin(lang_sorted)]
-    df = df.loc[df['source'].isin(allowed_sources)]
-    if before_switch:
-        df = df[(df["created_at"].dt.year == 2017) & (df["created_at"].dt.month < 11)]
-    else:
-        df = df[(df["created_at"].dt.year == 2019) & (df["created_at"].dt.month < 11)]
-    return df.groupby("lang").apply(lambda x: x['n_chars'].value_counts().sort_index())
-
-
-def lang_cramming_140_wrapper(lang_hist):
-    day_hist = lang_hist.hist_chars.reset_index(level=0, drop=True).to_frame()
-    return measure(day_hist=day_hist, measurement_at=140, measure='cramming')
-
-
-def lang_cramming_280_wrapper(lang_hist):
-    day_hist = lang_hist.hist_chars.reset_index(level=0, drop=True).to_frame()
-    return measure(day_hist=day_hist, measurement_at=280, measure='cramming')
+    start, end = before_period if before_switch else after_period
+    if not isinstance(file, str):
+        # a HistogramCube already holds the counts of all batches
+        return file.period_histograms(start, end, langs=lang_sorted, sources='allowed')
+    return scan_batch(file, lambda df: groupby_histograms(df.groupby("lang", observed=True), df['n_chars']), columns=['lang', 'n_chars'],
+                      langs=lang_sorted, sources=allowed_sources, start=start, end=end)
 
 
 if __name__ == "__main__":
@@ -48,28 +40,38 @@ if __name__ == "__main__":
                         default=20)
     parser.add_argument('--save-path', help='Where to save the output csv, default: /scratch/czestoch/tweet-length',
                         default='/scratch/czestoch/tweet-length')
+    parser.add_argument('--cube', help='Histogram cube saved by histogram_cube.py to use instead of scanning the batches',
+                        default=None)
+    parser.add_argument('--partials', help='Directory where the histograms of every batch and the fits are kept, so that'
+                                           ' the next run only scans new or changed batches and fits changed histograms',
+                        default=None)
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    add_batch_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
-    pandarallel.initialize(nb_workers=args.n_cores)
-    files = get_files()
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    set_batch_memory(args.batch_memory)
+    cube = load_cube(args.cube) if args.cube else None
 
-    output_before = multiprocess_batches(before_period_wrapper, files, n_cores=args.n_cores)
-    before = reduce(lambda a, b: pd.concat((a, b), axis=1).sum(axis=1), filter(lambda x: not x.empty, output_before))
-    before = before.to_frame().rename({0: "hist_chars"}, axis=1)
+    before = get_histograms(before_period_wrapper, get_files(*before_period), cube=cube,
+                            partials=args.partials)
 
     print("Fitting lognormal per language before the switch and estimate cramming at 140 per language...")
-    cramming_before_140 = before.groupby("lang").parallel_apply(lang_cramming_140_wrapper)
-    cramming_before_140.name = 'cramming_before_140'
+    cramming_before_140 = measure_columns(measures(before, 140, ['cramming'], **fit_options(args)), 'cramming',
+                                          'cramming_before_140')
 
-    output_after = multiprocess_batches(after_period_wrapper, files, n_cores=args.n_cores)
-    after = reduce(lambda a, b: pd.concat((a, b), axis=1).sum(axis=1), filter(lambda x: not x.empty, output_after))
-    after = after.to_frame().rename({0: "hist_chars"}, axis=1)
+    after = get_histograms(after_period_wrapper, get_files(*after_period), cube=cube,
+                           partials=args.partials)
 
     print("Fitting lognormal per language after the switch and estimate cramming at 280 per language...")
-    cramming_after_280 = after.groupby("lang").parallel_apply(lang_cramming_280_wrapper)
-    cramming_after_280.name = 'cramming_after_280'
+    cramming_after_280 = measure_columns(measures(after, 280, ['cramming'], **fit_options(args)), 'cramming',
+                                         'cramming_after_280')
 
     df = pd.merge(cramming_before_140.reset_index(), cramming_after_280.reset_index(), on='lang')
 
     print("Saving file...")
-    df.to_csv(os.path.join(args.save_path, "fig6_cramming_per_lang_before_vs_after.csv.gz"), index=False)
+    write_measurements(df, args.save_path, "fig6_cramming_per_lang_before_vs_after", output_format=args.output_format, index=False)
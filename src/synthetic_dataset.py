@@ -0,0 +1,77 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants import first_day, last_day, lang_sorted, lengths_dataset_path, mobile_sources, switch_date, web_sources
+
+automated_sources = ['<a href="https://about.twitter.com/products/tweetdeck" rel="nofollow">TweetDeck</a>',
+                     '<a href="http://instagram.com" rel="nofollow">Instagram</a>',
+                     '<a href="https://ifttt.com" rel="nofollow">IFTTT</a>',
+                     '<a href="http://twittbot.net/" rel="nofollow">twittbot.net</a>']
+sources = mobile_sources + web_sources + automated_sources
+source_weights = [0.35, 0.3, 0.03, 0.02, 0.15, 0.06, 0.04, 0.03, 0.02]
+# languages in lang_sorted order get a decreasing share of the tweets, with a few undefined ones
+lang_weights = np.append(1 / np.arange(1, len(lang_sorted) + 1) ** 0.8, 0.3)
+
+
+def generate_lengths(rng, n_rows, limits, mu, sigma, cramming=0.5):
+    # lognormal lengths, part of the tweets that don't fit under the limit are crammed just below it
+    n_chars = np.maximum(np.round(rng.lognormal(mu, sigma)), 1)
+    too_long = n_chars > limits
+    crammed = too_long & (rng.random(n_rows) < cramming)
+    n_chars[crammed] = limits[crammed] - np.floor(rng.exponential(3, crammed.sum()))
+    # the others are cut anywhere below the limit, as tweets rewritten to fit
+    cut = too_long & ~crammed
+    n_chars[cut] = rng.integers(1, limits[cut])
+    return np.clip(n_chars, 0, limits).astype(np.int64)
+
+
+def generate_batch(rng, n_rows, start, end, lang_mu):
+    langs = np.array(lang_sorted + ['und'])
+    lang = rng.choice(len(langs), size=n_rows, p=lang_weights / lang_weights.sum())
+    created_at = pd.Timestamp(start) + pd.to_timedelta(
+        np.sort(rng.integers(0, int((pd.Timestamp(end) - pd.Timestamp(start)).total_seconds()), n_rows)), unit='s')
+    limits = np.where(created_at < pd.Timestamp(switch_date), 140, 280)
+    n_chars = generate_lengths(rng, n_rows, limits, lang_mu[lang], rng.uniform(0.7, 0.9, n_rows))
+    return pd.DataFrame({'lang': langs[lang],
+                         'n_chars': n_chars,
+                         'source': np.array(sources)[rng.choice(len(sources), size=n_rows, p=source_weights)],
+                         'created_at': created_at,
+                         'user_n_tweets': np.round(rng.lognormal(8, 1.5, n_rows)).astype(np.int64) + 1})
+
+
+def generate_dataset(path, n_rows, n_batches=40, seed=0, row_group_size=100000):
+    # batches cover consecutive periods of time, as the tweets are sorted by creation time
+    rng = np.random.default_rng(seed)
+    # every language has its own typical length
+    lang_mu = np.linspace(3.6, 4.3, len(lang_weights))[rng.permutation(len(lang_weights))]
+    os.makedirs(path, exist_ok=True)
+    bounds = pd.date_range(first_day, pd.Timestamp(last_day) + pd.Timedelta(days=1), periods=n_batches + 1)
+    files = []
+    for i in range(n_batches):
+        df = generate_batch(rng, n_rows // n_batches + (i < n_rows % n_batches), bounds[i], bounds[i + 1], lang_mu)
+        file = os.path.join(path, f"lengths_derived_dataset_batch_{i+1}.parquet")
+        df.to_parquet(file, index=False, row_group_size=row_group_size)
+        files.append(file)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Generate batches with the schema of the tweet lengths dataset (lang, n_chars, source, created_at,'
+                    ' user_n_tweets) to run and benchmark the scripts without the real data')
+
+    parser.add_argument('--n-rows', type=int, help='How many tweets to generate in total, default: 4000000',
+                        default=4000000)
+    parser.add_argument('--n-batches', type=int, help='In how many batch files, default: 40', default=40)
+    parser.add_argument('--seed', type=int, help='Seed of the random generator, default: 0', default=0)
+    parser.add_argument('--save-path', help=f'Where to save the batches, default: {lengths_dataset_path}',
+                        default=lengths_dataset_path)
+
+    args = parser.parse_args()
+
+    print("Generating batches...")
+    files = generate_dataset(args.save_path, args.n_rows, n_batches=args.n_batches, seed=args.seed)
+    print(f"Saved {len(files)} batches to {args.save_path}")
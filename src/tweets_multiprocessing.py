@@ -1,20 +1,309 @@
+import json
 import os
-from multiprocessing import Pool
 import time
 
-from constants import lengths_dataset_path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
-def get_files():
-    return [os.path.join(lengths_dataset_path, f"lengths_derived_dataset_batch_{i+1}.parquet") for i in range(40)]
+import executors
+import instrumentation
+from constants import lengths_dataset_path, max_n_chars
+from histograms import HistogramAccumulator
+from partials import PartialStore, atomic_write, get_func_name, run_batch
 
-def multiprocess_batches(func, files, n_cores=10):
-    p = Pool(n_cores)
-    print('Parallelized on number of cores:', n_cores)
+batch_index_path = os.path.join(lengths_dataset_path, 'batch_index.json')
+# MB a worker can use to hold tweets of a batch, the whole batch is read at once when None
+batch_memory = None
+# rows decoded at a time when a batch is streamed
+scan_rows = 65536
+# a chunk of tweets takes about this many times its arrow size once converted to pandas and grouped
+chunk_overhead = 4
+# text columns read as categories, their distinct values are only decoded and compared once
+dictionary_columns = ['lang', 'source']
+
+
+def add_batch_arguments(parser):
+    parser.add_argument('--batch-memory', type=float, default=None,
+                        help='Stream every batch in chunks taking about this many MB per worker instead of reading'
+                             ' it at once, default: read whole batches')
+
+
+def set_batch_memory(memory):
+    # must be called before the executor is created
+    apply_batch_memory(memory)
+    executors.add_worker_setting(apply_batch_memory, memory)
+
+
+def apply_batch_memory(memory):
+    global batch_memory
+    batch_memory = memory
+
+
+def get_files(start=None, end=None):
+    files = [os.path.join(lengths_dataset_path, f"lengths_derived_dataset_batch_{i+1}.parquet") for i in range(40)]
+    if start is None and end is None:
+        return files
+    # skip batches without any tweet created in [start, end)
+    index = get_batch_index(files)
+    return [file for file in files
+            if index[file]['min_created_at'] is None
+            or ((start is None or pd.Timestamp(index[file]['max_created_at']) >= pd.Timestamp(start))
+                and (end is None or pd.Timestamp(index[file]['min_created_at']) < pd.Timestamp(end)))]
+
+
+def get_created_at_range(file):
+    metadata = pq.ParquetFile(file).metadata
+    column = metadata.schema.names.index('created_at')
+    min_created_at, max_created_at = [], []
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(column).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None, None, metadata.num_rows
+        min_created_at.append(statistics.min)
+        max_created_at.append(statistics.max)
+    if not min_created_at:
+        return None, None, metadata.num_rows
+    return str(min(min_created_at)), str(max(max_created_at)), metadata.num_rows
+
+
+def get_batch_index(files, index_path=batch_index_path):
+    # min and max created_at of every batch read from the parquet footers, cached until the file changes
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    updated = False
+    for file in files:
+        stat = os.stat(file)
+        entry = index.get(file)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            min_created_at, max_created_at, num_rows = get_created_at_range(file)
+            index[file] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'num_rows': num_rows,
+                           'min_created_at': min_created_at, 'max_created_at': max_created_at}
+            updated = True
+    if updated:
+        # other processes, e.g. shards on other nodes, can read the index while it is written
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(index, f, indent=1)
+        try:
+            atomic_write(index_path, write)
+        except OSError as e:
+            # read-only or shared copies of the dataset, the footers are read again by the next run
+            print(f"Couldn't cache the batch index in {index_path}: {e}")
+    return index
+
+
+def get_filters(langs=None, sources=None, start=None, end=None):
+    filters = []
+    if langs is not None:
+        filters.append(('lang', 'in', list(langs)))
+    if sources is not None:
+        filters.append(('source', 'in', list(sources)))
+    if start is not None:
+        filters.append(('created_at', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('created_at', '<', pd.Timestamp(end)))
+    return filters
+
+
+def get_mask(record_batch, filters):
+    mask = None
+    for column, op, value in filters:
+        values = record_batch.column(column)
+        if op == 'in' and pa.types.is_dictionary(values.type):
+            # filter the distinct values and pick the result of every row by its code
+            condition = pc.take(pc.is_in(values.dictionary, value_set=pa.array(value, type=values.type.value_type)),
+                                values.indices)
+        elif op == 'in':
+            condition = pc.is_in(values, value_set=pa.array(value, type=values.type))
+        elif op == '>=':
+            condition = pc.greater_equal(values, pa.scalar(value, type=values.type))
+        else:
+            condition = pc.less(values, pa.scalar(value, type=values.type))
+        mask = condition if mask is None else pc.and_(mask, condition)
+    return mask
+
+
+def get_row_groups(metadata, start=None, end=None):
+    # row groups that can hold tweets created in [start, end) according to their statistics
+    column = metadata.schema.names.index('created_at')
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(column).statistics
+        if statistics is not None and statistics.has_min_max and (
+                (start is not None and pd.Timestamp(statistics.max) < pd.Timestamp(start))
+                or (end is not None and pd.Timestamp(statistics.min) >= pd.Timestamp(end))):
+            continue
+        row_groups.append(i)
+    return row_groups
+
+
+def read_batch(file, columns, langs=None, sources=None, start=None, end=None):
+    # the filters are pushed into the parquet scan, row groups outside of them are never decoded
+    filters = get_filters(langs, sources, start, end)
+    with instrumentation.stage('read') as record:
+        df = compact_dtypes(pd.read_parquet(file, columns=columns, filters=filters or None,
+                                            read_dictionary=get_dictionary_columns(columns)))
+        if instrumentation.enabled():
+            record['rows_read'] = pq.read_metadata(file).num_rows
+            record['rows_kept'] = len(df)
+    return df
+
+
+def get_dictionary_columns(columns):
+    return [column for column in dictionary_columns if column in columns]
+
+
+def compact_dtypes(df):
+    # categories in the order of their values so that grouping by them orders the groups as plain strings would
+    for column in get_dictionary_columns(df.columns):
+        df[column] = df[column].cat.reorder_categories(df[column].cat.categories.sort_values())
+    # lengths outside of 0 to max_n_chars are never counted, they all become max_n_chars + 1 to fit in 16 bits
+    if 'n_chars' in df.columns:
+        n_chars = df['n_chars'].to_numpy()
+        df['n_chars'] = np.where((n_chars >= 0) & (n_chars <= max_n_chars), n_chars, max_n_chars + 1).astype(np.uint16)
+    return df
+
+
+def stream_batch(file, columns, memory, langs=None, sources=None, start=None, end=None):
+    # same tweets as read_batch in chunks of about memory MB, only scan_rows rows are decoded at a time
+    # so that the memory of a worker doesn't grow with the size of the batch
+    filters = get_filters(langs, sources, start, end)
+    read_columns = columns + [column for column, _, _ in filters if column not in columns]
+    parquet_file = pq.ParquetFile(file, read_dictionary=get_dictionary_columns(read_columns))
+    # unlike the dataset scanner, iter_batches doesn't read ahead of the chunk being processed
+    scanner = parquet_file.iter_batches(batch_size=scan_rows, columns=read_columns,
+                                        row_groups=get_row_groups(parquet_file.metadata, start, end))
+    rows_read = parquet_file.metadata.num_rows
+    n_chunks = 0
+    while True:
+        with instrumentation.stage('read') as record:
+            record_batches, size = [], 0
+            for record_batch in scanner:
+                if filters:
+                    record_batch = record_batch.filter(get_mask(record_batch, filters))
+                record_batches.append(record_batch)
+                size += record_batch.nbytes
+                if size * chunk_overhead >= memory * 2 ** 20:
+                    break
+            table = pa.Table.from_batches(record_batches) if record_batches else \
+                parquet_file.schema_arrow.empty_table()
+            df = compact_dtypes(table.select(columns).to_pandas())
+            # the rows of the batch are counted once
+            record.update(rows_read=rows_read, rows_kept=len(df))
+            rows_read = 0
+        # the last chunk is empty, it is only passed on when the batch has no tweet at all
+        if record_batches or n_chunks == 0:
+            n_chunks += 1
+            yield df
+        if not record_batches:
+            return
+
+
+def iter_batch(file, columns, **filters):
+    # the whole batch, or chunks of it within batch_memory
+    if batch_memory is None:
+        yield read_batch(file, columns, **filters)
+    else:
+        yield from stream_batch(file, columns, batch_memory, **filters)
+
+
+def scan_batch(file, process, columns, **filters):
+    # histograms of a batch computed by process from its tweets, chunk by chunk within batch_memory
+    if batch_memory is None:
+        return process(read_batch(file, columns, **filters))
+    accumulator = HistogramAccumulator()
+    for df in stream_batch(file, columns, batch_memory, **filters):
+        accumulator.add(process(df))
+    return accumulator.to_frame()
+
+
+def get_batch_rows(files):
+    # tweets in every batch, from the parquet footers
+    index = get_batch_index(files)
+    return [index[file]['num_rows'] for file in files]
+
+
+def multiprocess_batches(func, files, merge=None, rows=None):
+    # with merge, the output of every batch is passed to merge as soon as it is ready instead of being kept,
+    # batches are started largest first so that a big batch started last doesn't keep the other workers waiting,
+    # rows are the sizes of the batches, read from their metadata by default
+    executor = executors.get_executor()
+    print(f'Parallelized with the {executors.backend} executor on number of cores:', executor.n_workers)
+    rows = get_batch_rows(files) if rows is None else rows
+    order = sorted(range(len(files)), key=lambda i: -rows[i])
     start = time.time()
-    output = p.map(func, files)
-    p.close()
-    p.join()
+    if instrumentation.enabled():
+        output = instrumented_map(executor, func, [files[i] for i in order], merge)
+    elif merge is None:
+        output = executor.map(func, [files[i] for i in order])
+    else:
+        output = None
+        for batch_output in executor.imap_unordered(func, [files[i] for i in order]):
+            merge(batch_output)
+    if output is not None:
+        # back in the order of files
+        output = [batch_output for _, batch_output in sorted(zip(order, output), key=lambda pair: pair[0])]
     end = time.time()
     elapsed = end - start
     print('Elapsed time:', time.strftime("%H:%M:%S", time.gmtime(elapsed)))
+    if instrumentation.enabled():
+        instrumentation.log({'event': 'pool', 'seconds': elapsed, 'n_cores': executor.n_workers,
+                             'n_batches': len(files)})
     return output
+
+
+def instrumented_map(executor, func, files, merge=None):
+    # same as multiprocess_batches, with the record of every batch logged as it comes back
+    tasks = [(func, file) for file in files]
+    if merge is None:
+        results = executor.map(instrumentation.run_instrumented, tasks)
+    else:
+        results = executor.imap_unordered(instrumentation.run_instrumented, tasks)
+    outputs = []
+    for output, record in results:
+        instrumentation.log(record)
+        if merge is None:
+            outputs.append(output)
+        else:
+            merge(output)
+    return outputs if merge is None else None
+
+
+def get_histograms(func, files, cube=None, partials=None):
+    # func can be evaluated on a HistogramCube instead of the batches, see histogram_cube.py,
+    # with partials only the batches that changed since the last run are scanned
+    if cube is not None:
+        return func(cube)
+    if partials is not None:
+        return get_histograms_incremental(func, files, partials)
+    accumulator = HistogramAccumulator()
+    multiprocess_batches(func, files, merge=accumulator.add)
+    return accumulator.to_frame()
+
+
+def get_histograms_incremental(func, files, directory):
+    # only batches that are new or changed since their partial histograms were saved are scanned,
+    # every batch is saved as soon as it is scanned so that a killed run resumes where it stopped
+    store = PartialStore(directory, get_func_name(func))
+    accumulator = HistogramAccumulator()
+    stale = []
+    for file in files:
+        if store.is_current(file):
+            accumulator.add(store.load(file))
+        else:
+            stale.append(file)
+    print(f'Reusing the histograms of {len(files) - len(stale)} batches, scanning {len(stale)} batches')
+
+    def merge(output):
+        file, hists, entry = output
+        store.save(file, hists, entry)
+        accumulator.add(hists)
+
+    if stale:
+        multiprocess_batches(run_batch, [(func, file) for file in stale], merge=merge, rows=get_batch_rows(stale))
+    return accumulator.to_frame()
@@ -0,0 +1,102 @@
+import argparse
+import warnings
+import pandas as pd
+import executors
+import instrumentation
+from scipy.optimize import OptimizeWarning
+
+from measurements_io import add_output_arguments, write_measurements
+from measure import add_fit_arguments, fit_options, lay_out_bounds, measures
+from histogram_cube import load_cube
+
+from constants import lang_sorted
+
+warnings.filterwarnings('ignore', category=OptimizeWarning)
+
+window_measure_names = ['runover', 'cramming', 'empirical fraction']
+
+
+def get_windows(cube, windows, freq):
+    # [start, end) of the given windows and of every period of freq covered by the cube
+    windows = [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in windows]
+    if freq is not None:
+        windows += [(period.start_time, period.end_time.normalize() + pd.Timedelta(days=1))
+                    for period in pd.period_range(cube.dates[0], cube.dates[-1], freq=freq)]
+    return windows
+
+
+def window_histograms(cube, windows, langs, sources):
+    # two lookups in the prefix sums of the cube per window
+    hists = [cube.period_histograms(start, end, langs=langs, sources=sources) for start, end in windows]
+    return pd.concat(hists, keys=windows, names=['start', 'end'])
+
+
+def rolling_histograms(cube, days, langs, sources):
+    hists = cube.rolling_histograms(days, langs=langs, sources=sources)
+    end = pd.DatetimeIndex(pd.to_datetime(hists.index.get_level_values('created_at')) + pd.Timedelta(days=1))
+    # the first windows only cover the days of the cube
+    start = end - pd.Timedelta(days=days)
+    start = start.where(start >= cube.dates[0], cube.dates[0])
+    hists.index = pd.MultiIndex.from_arrays([start, end, hists.index.get_level_values('lang')],
+                                            names=['start', 'end', 'lang'])
+    return hists
+
+
+def window_measurements(hists, measurement_at, names, options):
+    df = measures(hists, measurement_at, names, **options)
+    df = lay_out_bounds(lambda suffix: df[[name + suffix for name in names]].set_axis(names, axis=1).melt(
+        var_name='measure', value_name='measurement', ignore_index=False), options['n_replicates'])
+    df['measurement_at'] = measurement_at
+    return df.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Measures per language over any windows of days, from the prefix sums of the histogram cube'
+                    ' without scanning the batches again')
+
+    parser.add_argument('--n-cores', type=int, help='How many cores to use with multiprocessing, default: 20', default=20)
+    parser.add_argument('--save-path', help='Where to save the output csv, default: ../data/measurements',
+                        default='../data/measurements')
+    parser.add_argument('--cube', required=True, help='Histogram cube saved by histogram_cube.py, or its shard directory')
+    parser.add_argument('--window', nargs=2, action='append', default=[], metavar=('START', 'END'),
+                        help='Window of days from START to END excluded, can be repeated')
+    parser.add_argument('--freq', default=None,
+                        help='Also measure every period of this pandas frequency covered by the cube, e.g. W or M')
+    parser.add_argument('--rolling', type=int, default=None,
+                        help='Instead of windows, measure the given number of days up to every day of the cube')
+    parser.add_argument('--measurement-at', type=int, choices=[140, 280], default=280,
+                        help='Limit at which the measures are taken, default: 280')
+    parser.add_argument('--measures', nargs='+', choices=window_measure_names, default=['runover', 'cramming'],
+                        help='Measures to take, default: runover cramming')
+    parser.add_argument('--sources', choices=['allowed', 'all'], default='allowed',
+                        help='Count web and mobile tweets (allowed) or also automated ones (all), default: allowed')
+    parser.add_argument('--langs', nargs='+', default=lang_sorted, help='Languages to measure, default: all 23')
+    parser.add_argument('--name', default='window_measures', help='Name of the output, default: window_measures')
+    add_fit_arguments(parser)
+    add_output_arguments(parser)
+    executors.add_executor_arguments(parser)
+    instrumentation.add_instrumentation_arguments(parser)
+    # the fits can still be kept in --fit-store, there are no batches to keep partials of
+    parser.set_defaults(partials=None)
+
+    args = parser.parse_args()
+    executors.initialize(args.n_cores, args.executor)
+    instrumentation.initialize(args.instrument)
+    cube = load_cube(args.cube)
+
+    if args.rolling is not None:
+        print(f"Aggregating the histograms of the {args.rolling} days up to every day...")
+        hists = rolling_histograms(cube, args.rolling, args.langs, args.sources)
+    else:
+        windows = get_windows(cube, args.window, args.freq)
+        if not windows:
+            parser.error('give --window, --freq or --rolling')
+        print(f"Aggregating the histograms of {len(windows)} windows...")
+        hists = window_histograms(cube, windows, args.langs, args.sources)
+
+    print(f"Fitting {len(hists)} histograms and measuring {', '.join(args.measures)} at {args.measurement_at}...")
+    df = window_measurements(hists, args.measurement_at, args.measures, fit_options(args))
+
+    print("Saving file...")
+    write_measurements(df, args.save_path, args.name, output_format=args.output_format, index=False)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the scripts import each other from src and the constants from the root, as when they are run from src
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(root, 'src'), root]
@@ -0,0 +1,41 @@
+import argparse
+
+import numpy as np
+import pytest
+
+import fit_store
+from fit_store import FitStore, get_filesystem
+from measure import get_store_path
+
+
+def test_get_filesystem(tmp_path):
+    mounts = tmp_path / 'mounts'
+    mounts.write_text('/dev/sda1 / ext4 rw 0 0\n'
+                      'server:/export /mnt/shared nfs4 rw 0 0\n'
+                      '/dev/sdb1 /mnt/shared/local\\040disk xfs rw 0 0\n')
+    assert get_filesystem('/home/fits.sqlite', mounts) == 'ext4'
+    assert get_filesystem('/mnt/shared/fits.sqlite', mounts) == 'nfs4'
+    assert get_filesystem('/mnt/sharedfits.sqlite', mounts) == 'ext4'
+    assert get_filesystem('/mnt/shared/local disk/fits.sqlite', mounts) == 'xfs'
+    assert get_filesystem('/', tmp_path / 'missing') is None
+
+
+def test_store_on_network_filesystem(tmp_path, monkeypatch):
+    path = str(tmp_path / 'fits.sqlite')
+    store = FitStore(path)
+    store.put(['a'], 140, 'batch', np.array([[3.5, 0.6, 1, 10]]), [100])
+    params, found = store.get(['a', 'b'], 140, 'batch')
+    assert found.tolist() == [True, False]
+    monkeypatch.setattr(fit_store, 'get_filesystem', lambda path: 'nfs')
+    with pytest.raises(ValueError):
+        FitStore(path)
+
+
+def test_store_in_shard_directory(tmp_path):
+    shards = tmp_path / 'shards'
+    shards.mkdir()
+    args = argparse.Namespace(fit_store=str(shards / 'fits.sqlite'), partials=None, cube=str(shards))
+    with pytest.raises(ValueError):
+        get_store_path(args)
+    args.fit_store = str(tmp_path / 'fits.sqlite')
+    assert get_store_path(args) == args.fit_store
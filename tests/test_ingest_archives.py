@@ -0,0 +1,55 @@
+import bz2
+import io
+import json
+import os
+import tarfile
+
+import pandas as pd
+import pytest
+
+from ingest_archives import get_member_key, iter_tweet_frames, list_members, tweet_frame
+
+
+def tweet_line(created_at='Wed Jan 10 12:00:00 +0000 2018', text='Tom &amp; Jerry are here', lang='en'):
+    return json.dumps({'created_at': created_at, 'lang': lang, 'source': 'web', 'text': text,
+                       'display_text_range': [0, 20]})
+
+
+def write_tar(path, mode, members):
+    with tarfile.open(path, mode) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def read_tweets(path):
+    return pd.concat([df for task in list_members(str(path)) for _, df in iter_tweet_frames(task)])
+
+
+@pytest.mark.parametrize('mode, suffix', [('w', '.tar'), ('w:gz', '.tar.gz'), ('w:bz2', '.tar.bz2')])
+def test_compressed_tars(tmp_path, mode, suffix):
+    lines = '\n'.join([tweet_line(), tweet_line(text='hello')]).encode()
+    path = tmp_path / f'tweets{suffix}'
+    write_tar(path, mode, {'a/1.json.bz2': bz2.compress(lines), 'a/2.json': lines, 'a/readme.txt': b'no tweets'})
+    assert [name for _, name, _ in list_members(str(path))] == ['a/1.json.bz2', 'a/2.json']
+    df = read_tweets(path)
+    assert len(df) == 4
+    assert sorted(df.n_chars) == [5, 5, 20, 20]
+
+
+def test_same_archive_name_in_other_directories(tmp_path):
+    keys = set()
+    for month in ['01', '02']:
+        os.makedirs(tmp_path / month)
+        path = tmp_path / month / 'tweets.tar'
+        write_tar(path, 'w', {'1.json': tweet_line().encode()})
+        keys.update(get_member_key(task) for task in list_members(str(path)))
+    assert len(keys) == 2
+
+
+def test_chunk_without_valid_dates():
+    df = tweet_frame([('not a date', 'en', 'web', 10), (None, 'en', 'web', 20)])
+    assert df.empty
+    df = tweet_frame([('not a date', 'en', 'web', 10), ('Wed Jan 10 12:00:00 +0000 2018', 'en', 'web', 20)])
+    assert df.created_at.tolist() == [pd.Timestamp('2018-01-10 12:00:00')]
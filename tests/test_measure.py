@@ -0,0 +1,46 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from measure import fit, get_series, is_time_index
+
+
+def lognormal_hists(index, seed=0):
+    # histograms of lognormal lengths with parameters drifting along the index
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(len(index)):
+        n_chars = np.round(rng.lognormal(3.5 + 0.05 * i, 0.6, 5000)).astype(int)
+        rows.append(np.bincount(n_chars[n_chars <= 280], minlength=281))
+    return pd.DataFrame(rows, index=index, columns=range(281))
+
+
+def test_is_time_index():
+    days = [datetime.date(2017, 1, 1) + datetime.timedelta(days=i) for i in range(3)]
+    assert is_time_index(pd.Index(days))
+    assert is_time_index(pd.MultiIndex.from_product([['en', 'ja'], pd.date_range('2017-01-01', periods=3)]))
+    assert not is_time_index(pd.Index(['en', 'ja', 'pt'], name='lang'))
+    assert not is_time_index(pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=2), ['en', 'ja']]))
+
+
+def test_get_series_orders_days():
+    index = pd.MultiIndex.from_arrays([['en', 'ja', 'en', 'ja'], pd.to_datetime(['2017-01-02', '2017-01-01',
+                                                                                 '2017-01-01', '2017-01-02'])])
+    assert [rows.tolist() for rows in get_series(index)] == [[2, 0], [1, 3]]
+
+
+def test_no_warm_start_without_days():
+    hists = lognormal_hists(pd.Index(['en', 'ja', 'pt', 'tl'], name='lang'))
+    warm = fit(hists, 140, method='batch', warm_start=True)
+    cold = fit(hists, 140, method='batch')
+    assert not warm.warm_start
+    np.testing.assert_array_equal(warm.mu, cold.mu)
+    np.testing.assert_array_equal(warm.sigma, cold.sigma)
+
+
+def test_warm_start_per_day():
+    hists = lognormal_hists(pd.Index(pd.date_range('2017-01-01', periods=4).date, name='created_at'))
+    warm = fit(hists, 140, method='batch', warm_start=True)
+    assert warm.warm_start
+    assert warm.converged.all()